@@ -1,11 +1,15 @@
 # ================ 你原来的代码保持不变 ================
 import os
 import argparse
+import pathlib
+import threading
+from collections import OrderedDict
 from PIL import Image
 import numpy as np
 import torch
-from torchvision.transforms.functional import to_tensor, to_pil_image
-from model import Generator
+from metrics import NULL_METRICS, attach_block_hooks, logger
+from weightstore import load_generator
+import imageops
 
 torch.backends.cudnn.enabled = False
 torch.backends.cudnn.benchmark = False
@@ -13,74 +17,644 @@ torch.backends.cudnn.deterministic = True
 
 def load_image(image_path, max_edge=1024, x32=True):
     img = Image.open(image_path).convert("RGB")
-    ow, oh = img.size
+    return resize_for_model(img, max_edge=max_edge, x32=x32)
+
+def model_size(ow, oh, max_edge=1024, x32=True):
+    """原图 (w, h) → 模型输入 (w, h)：长边不超过 max_edge，可选向下取整到 32 的倍数"""
     scale = min(max_edge / ow, max_edge / oh, 1.0)
     nw, nh = int(ow * scale), int(oh * scale)
     if x32:
         nw = (nw // 32) * 32
         nh = (nh // 32) * 32
+    return nw, nh
+
+def resize_for_model(img, max_edge=1024, x32=True):
+    """把 PIL 图缩到模型输入尺寸，返回 (缩放后的图, 原始 (w, h))"""
+    ow, oh = img.size
+    nw, nh = model_size(ow, oh, max_edge=max_edge, x32=x32)
     if (nw, nh) != (ow, oh):
         img = img.resize((nw, nh), Image.LANCZOS)
     return img, (ow, oh)
 
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp", ".tiff")
+
+def list_images(input_dir, recursive=False):
+    """目录下的图片；recursive=True 时递归子目录，返回相对 input_dir 的路径"""
+    if not recursive:
+        return [n for n in sorted(os.listdir(input_dir)) if n.lower().endswith(IMAGE_EXTS)]
+    out = []
+    for dirpath, dirnames, files in os.walk(input_dir):
+        dirnames.sort()
+        rel = os.path.relpath(dirpath, input_dir)
+        out.extend(os.path.normpath(os.path.join(rel, n)) for n in sorted(files) if n.lower().endswith(IMAGE_EXTS))
+    return out
+
+def output_path(path, output_dir, input_root=None):
+    """输出路径：给了 input_root 时保留相对目录结构，否则只取文件名"""
+    rel = os.path.relpath(path, input_root) if input_root else os.path.basename(path)
+    out = os.path.join(output_dir, rel)
+    os.makedirs(os.path.dirname(out) or ".", exist_ok=True)
+    return out
+
+def plan_batches(paths, batch_size=1, max_batch_pixels=2 * 1024 * 1024, max_edge=1024, x32=True):
+    """按模型输入尺寸分桶，每桶再切成 ≤batch_size 且总像素 ≤max_batch_pixels 的批
+
+    只读文件头拿尺寸，不解码。返回 [[path, ...], ...]，同一批里的图输入尺寸一致。
+    读不出文件头的图各自单独成批，错误留到解码时再报。
+    """
+    buckets = OrderedDict()
+    for path in paths:
+        try:
+            with Image.open(path) as im:
+                size = model_size(*im.size, max_edge=max_edge, x32=x32)
+        except Exception:
+            size = None
+        buckets.setdefault(size, []).append(path)
+    batches = []
+    for size, items in buckets.items():
+        n = 1 if size is None else max(1, min(batch_size, max_batch_pixels // max(size[0] * size[1], 1)))
+        batches.extend(items[i:i + n] for i in range(0, len(items), n))
+    return batches
+
+def convert_batch(net, paths, device="cpu", upsample_align=False, max_edge=1024, metrics=NULL_METRICS):
+    """一批同尺寸图片一次前向，返回与 paths 对应的 3xHxW uint8 输出（原图尺寸，用 imageops.save 保存）
+
+    解码、缩放、归一化、还原尺寸都在张量上完成（见 imageops），不经过 PIL 中间图。
+    """
+    imgs = []
+    for p in paths:
+        with metrics.timer("load"):
+            imgs.append(imageops.load(p))
+    sizes = [tuple(im.shape[-2:]) for im in imgs]
+    targets = {model_size(w, h, max_edge=max_edge, x32=True) for h, w in sizes}
+    if len(targets) != 1:
+        raise ValueError(f"同一批的图模型输入尺寸不一致: {sorted(targets)}")
+    with metrics.timer("resize"):
+        x = imageops.preprocess(imgs, targets.pop())
+    with metrics.timer("forward"):
+        out = forward_model(net, x, device, upsample_align)
+    with metrics.timer("postprocess"):
+        return imageops.postprocess(out, sizes)[0]
+
+def _convert_isolated(net, batch, device, upsample_align, metrics=NULL_METRICS, max_edge=1024):
+    """整批失败时逐张重试，坏图不连累同批的其他图；返回 [(path, uint8 输出或 None, 异常或 None)]"""
+    try:
+        return [(p, img, None) for p, img in zip(batch, convert_batch(net, batch, device, upsample_align,
+                                                                      max_edge, metrics))]
+    except Exception as e:
+        if len(batch) == 1:
+            return [(batch[0], None, e)]
+    return [r for p in batch for r in _convert_isolated(net, [p], device, upsample_align, metrics, max_edge)]
+
+def _report_failure(metrics, path, err):
+    logger.warning("转换失败 %s: %s", path, err)
+    metrics.inc("failed")
+    metrics.event(status="failed", path=path, error=repr(err))
+
+def _serve_cached(cache, paths, output_dir, checkpoint, upsample_align, variant, keys,
+                  input_root=None, on_hit=None):
+    """命中结果缓存的图直接把缓存字节写到输出目录，返回未命中的路径；未命中的 key 记进 keys"""
+    from result_cache import make_policy
+    misses = []
+    for path in paths:
+        with open(path, "rb") as f:
+            data = f.read()
+        ext = os.path.splitext(path)[-1].lower()
+        key = cache.make_key(data, checkpoint, make_policy(1024, variant, ext), upsample_align)
+        hit = cache.get(key)
+        if hit is None:
+            keys[path] = key
+            misses.append(path)
+        else:
+            out_path = output_path(path, output_dir, input_root)
+            with open(out_path, "wb") as f:
+                f.write(hit)
+            if on_hit is not None:
+                on_hit(path, out_path)
+    return misses
+
+def _store_cached(cache, keys, path, out_path):
+    if cache is not None and path in keys and out_path is not None:
+        with open(out_path, "rb") as f:
+            cache.put(keys[path], f.read())
+
+def convert_dir(net, input_dir, output_dir, device="cpu", upsample_align=False,
+                batch_size=1, max_batch_pixels=2 * 1024 * 1024,
+                decode_workers=0, encode_workers=0,
+                cache=None, checkpoint=None, variant="fp32",
+                recursive=False, manifest=None, metrics=NULL_METRICS,
+                processes=0, threads_per_process=None):
+    """整目录转换；decode_workers/encode_workers > 0 时走 pipeline 流水线并返回其统计
+
+    processes > 0 时走 procpool 多进程，每个进程 threads_per_process 个线程（默认核数/进程数）。
+    传入 cache（result_cache.ResultCache）时需同时给出 checkpoint，先查结果缓存，只算未命中的图；
+    variant 描述会改变输出的模型变体（如精度模式），参与缓存 key。
+    recursive=True 时递归子目录并在 output_dir 下保持同样的目录结构。
+    传入 manifest（manifest.Manifest）即增量同步：只转换新增/变化的图，每转完一张记一笔。
+    metrics（metrics.Metrics）记录各阶段耗时和 processed/skipped/cached/failed 计数；
+    单张图失败只记 failed 并继续，不中断整个目录。
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    rels = list_images(input_dir, recursive)
+    if recursive:
+        # 输出目录在输入目录里面时，别把上次的结果当成输入
+        out_abs = os.path.abspath(output_dir) + os.sep
+        rels = [r for r in rels if not os.path.abspath(os.path.join(input_dir, r)).startswith(out_abs)]
+    todo = manifest.plan(input_dir, rels) if manifest is not None else rels
+    metrics.inc("skipped", len(rels) - len(todo))
+    paths = [os.path.join(input_dir, r) for r in todo]
+    root = input_dir if recursive else None
+    keys = {}
+
+    def cached(path, out_path):
+        metrics.inc("cached")
+        done(path, out_path)
+
+    def done(path, out_path):
+        _store_cached(cache, keys, path, out_path)
+        if manifest is not None and out_path is not None:
+            manifest.record(os.path.relpath(path, input_dir), os.path.relpath(out_path, output_dir), path)
+
+    try:
+        if cache is not None:
+            paths = _serve_cached(cache, paths, output_dir, checkpoint, upsample_align, variant, keys,
+                                  input_root=root, on_hit=cached)
+        def collect(results):
+            for r in results:
+                if r.error is not None:
+                    _report_failure(metrics, r.path, r.error)
+                    continue
+                metrics.inc("processed")
+                done(r.path, r.out_path)
+
+        if processes > 0:
+            from procpool import iter_convert_processes
+            collect(iter_convert_processes(net, paths, output_dir, device, upsample_align, processes,
+                                           threads_per_process, batch_size, max_batch_pixels, input_root=root,
+                                           metrics=metrics))
+            return
+        if decode_workers > 0 or encode_workers > 0:
+            from pipeline import PipelineStats, iter_convert
+            stats = PipelineStats()
+            collect(iter_convert(net, paths, output_dir, device, upsample_align,
+                                 decode_workers=decode_workers, encode_workers=encode_workers,
+                                 batch_size=batch_size, max_batch_pixels=max_batch_pixels,
+                                 stats=stats, input_root=root, metrics=metrics))
+            return stats
+        for batch in plan_batches(paths, batch_size, max_batch_pixels):
+            for path, out, err in _convert_isolated(net, batch, device, upsample_align, metrics):
+                if err is None:
+                    out_path = output_path(path, output_dir, root)
+                    try:
+                        with metrics.timer("save"):
+                            imageops.save(out, out_path)
+                    except Exception as e:
+                        err = e
+                if err is not None:
+                    _report_failure(metrics, path, err)
+                    continue
+                metrics.inc("processed")
+                done(path, out_path)
+    finally:
+        if manifest is not None:
+            manifest.compact(keep=set(rels))
+
 def test(args):
     device = args.device
-    net = Generator()
-    net.load_state_dict(torch.load(args.checkpoint, map_location="cpu"))
-    net.to(device).eval()
-    os.makedirs(args.output_dir, exist_ok=True)
-    for image_name in sorted(os.listdir(args.input_dir)):
-        if os.path.splitext(image_name)[-1].lower() not in [".jpg", ".jpeg", ".png", ".bmp", ".tiff"]:
+    if args.processes != "0" and args.precision in ("int8", "int8-dynamic"):
+        # 量化模块的 packed 权重不能 share_memory / 随 spawn pickle 给子进程
+        raise ValueError(f"--precision {args.precision} 不支持 --processes，请用单进程或 --precision bf16")
+    # 分块 / 人脸模式逐张单独处理，不走结果缓存、清单、精度转换和多进程
+    for mode, on in (("--tiled", args.tiled), ("--faces", args.faces)):
+        if not on:
             continue
-        image_path = os.path.join(args.input_dir, image_name)
-        image, (ow, oh) = load_image(image_path, max_edge=1024, x32=True)
-        with torch.no_grad():
-            x = to_tensor(image).unsqueeze(0) * 2 - 1
-            out = net(x.to(device), args.upsample_align).cpu()
-            out = out.squeeze(0).clip(-1, 1) * 0.5 + 0.5
-            out = torch.nn.functional.interpolate(
-                out.unsqueeze(0), size=(oh, ow), mode="bilinear", align_corners=False
-            ).squeeze(0)
-            out_img = to_pil_image(out)
-        out_img.save(os.path.join(args.output_dir, image_name))
+        unsupported = [flag for flag, set_ in (("--sync", args.sync),
+                                               ("--faces", args.faces and mode == "--tiled"),
+                                               ("--processes", args.processes != "0"),
+                                               ("--precision", args.precision != "fp32"),
+                                               ("--optimize", args.optimize),
+                                               ("--profile-blocks", args.profile_blocks)) if set_]
+        if unsupported:
+            raise ValueError(f"{mode} 不支持 {' '.join(unsupported)}")
+    metrics = NULL_METRICS
+    if args.metrics_log or args.metrics_prom or args.profile_blocks:
+        from metrics import Metrics, LogSink, PrometheusFileSink
+        sinks = [LogSink()] if args.metrics_log else []
+        if args.metrics_prom:
+            sinks.append(PrometheusFileSink(args.metrics_prom))
+        metrics = Metrics(sinks)
+    if args.tiled:
+        from tiling import convert_dir_tiled
+        try:
+            convert_dir_tiled(args.checkpoint, args.input_dir, args.output_dir, device, args.upsample_align,
+                              budget_bytes=args.tile_budget_mb * 1024 * 1024, norm=args.tile_norm,
+                              recursive=args.recursive, metrics=metrics)
+        finally:
+            metrics.flush()
+        if metrics.enabled:
+            print("metrics:", metrics.snapshot())
+        return
+    if args.faces:
+        from faces import convert_dir_faces, load_boxes
+        try:
+            convert_dir_faces(args.checkpoint, args.input_dir, args.output_dir, device, args.upsample_align,
+                              boxes=load_boxes(args.face_boxes) if args.face_boxes else None,
+                              background=args.face_background, bg_edge=args.face_bg_edge,
+                              recursive=args.recursive, metrics=metrics)
+        finally:
+            metrics.flush()
+        if metrics.enabled:
+            print("metrics:", metrics.snapshot())
+        return
+    with metrics.timer("load_model"):
+        net = get_model(args.checkpoint, device, optimize=args.optimize)
+    if args.precision != "fp32":
+        from precision import prepare_precision
+        net = prepare_precision(net, args.precision, args.calib_dir)
+    processes = args.processes
+    if processes == "auto":
+        from procpool import autotune_processes
+        processes, scores = autotune_processes(net)
+        print("processes:", processes, {k: round(v, 2) for k, v in scores.items()})
+    processes = int(processes)
+    cache = None
+    if not args.no_cache:
+        from result_cache import get_cache
+        cache = get_cache()
+    manifest = None
+    if args.sync:
+        from manifest import open_manifest
+        manifest = open_manifest(args.output_dir, args.checkpoint, args.upsample_align, args.precision)
+    hooks = attach_block_hooks(net, metrics) if args.profile_blocks and not processes else []
+    try:
+        stats = convert_dir(net, args.input_dir, args.output_dir, device, args.upsample_align,
+                            batch_size=args.batch_size, max_batch_pixels=args.max_batch_pixels,
+                            decode_workers=args.decode_workers, encode_workers=args.encode_workers,
+                            cache=cache, checkpoint=args.checkpoint, variant=args.precision,
+                            recursive=args.recursive, manifest=manifest, metrics=metrics,
+                            processes=processes, threads_per_process=args.threads_per_process)
+    finally:
+        for h in hooks:
+            h.remove()
+        metrics.flush()
+    if stats is not None:
+        print(stats)
+    if cache is not None:
+        print("cache:", cache.stats())
+    if manifest is not None:
+        print("sync:", manifest.summary())
+    if metrics.enabled:
+        print("metrics:", metrics.snapshot())
+
+# ================ 模型注册表：进程内复用已加载的 Generator ================
+WEIGHTS_DIR = pathlib.Path(__file__).parent / "weights"
+
+def _model_nbytes(net):
+    return sum(t.numel() * t.element_size() for t in list(net.parameters()) + list(net.buffers()))
+
+class ModelRegistry:
+    """线程安全的 Generator 缓存
+
+    键为 (权重绝对路径, mtime, device, dtype, optimize)；权重文件被替换后 mtime 变化会自动重新加载。
+    optimize=True 时缓存的是 optimize.optimize_for_inference 融合后的模型。
+    超出 max_bytes 时按 LRU 淘汰最久未用的模型。
+    权重经 weightstore 以 mmap 加载并按 .sha256 校验，fp32/CPU 时参数直接映射文件页。
+    """
+
+    def __init__(self, max_bytes=512 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._models = OrderedDict()   # key -> (net, nbytes)
+        self._lock = threading.Lock()
+        self._loading = {}             # key -> Lock，避免同一权重被多个线程重复加载
+
+    @staticmethod
+    def make_key(checkpoint, device="cpu", dtype=torch.float32, optimize=False):
+        path = os.path.abspath(checkpoint)
+        return path, os.stat(path).st_mtime_ns, str(device), dtype, bool(optimize)
+
+    def get(self, checkpoint, device="cpu", dtype=torch.float32, optimize=False):
+        key = self.make_key(checkpoint, device, dtype, optimize)
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                return self._models[key][0]
+            load_lock = self._loading.setdefault(key, threading.Lock())
+        with load_lock:
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    return self._models[key][0]
+            net = load_generator(key[0])
+            if optimize:
+                from optimize import optimize_for_inference
+                net = optimize_for_inference(net)
+            net.to(device=device, dtype=dtype).eval()
+            self._put(key, net)
+        with self._lock:
+            self._loading.pop(key, None)
+        return net
+
+    def _put(self, key, net):
+        nbytes = _model_nbytes(net)
+        with self._lock:
+            # 同一路径的旧版本权重（mtime 不同）直接丢弃
+            for old in [k for k in self._models if k[0] == key[0] and k[1] != key[1]]:
+                del self._models[old]
+            self._models[key] = (net, nbytes)
+            total = sum(n for _, n in self._models.values())
+            while total > self.max_bytes and len(self._models) > 1:
+                _, (_, n) = self._models.popitem(last=False)
+                total -= n
+
+    def preload(self, weights_dir=WEIGHTS_DIR, device="cpu", dtype=torch.float32):
+        """加载目录下所有 .pt，返回成功加载的路径列表"""
+        loaded = []
+        for p in sorted(pathlib.Path(weights_dir).glob("*.pt")):
+            try:
+                self.get(str(p), device, dtype)
+                loaded.append(str(p))
+            except Exception as e:
+                logger.warning("预加载 %s 失败: %s", p, e)
+        return loaded
+
+    def preload_async(self, weights_dir=WEIGHTS_DIR, device="cpu", dtype=torch.float32):
+        """后台线程逐个加载，立即返回线程；期间请求到还没加载的模型时 get 会按需加载（不会重复加载）"""
+        t = threading.Thread(target=self.preload, args=(weights_dir, device, dtype),
+                             name="animegan-preload", daemon=True)
+        t.start()
+        return t
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+
+    def __len__(self):
+        return len(self._models)
+
+    @property
+    def nbytes(self):
+        with self._lock:
+            return sum(n for _, n in self._models.values())
+
+_registry = ModelRegistry()
+
+def get_model(checkpoint, device="cpu", dtype=torch.float32, optimize=False):
+    return _registry.get(checkpoint, device, dtype, optimize)
+
+def preload_models(weights_dir=WEIGHTS_DIR, device="cpu", dtype=torch.float32, background=False):
+    if background:
+        return _registry.preload_async(weights_dir, device, dtype)
+    return _registry.preload(weights_dir, device, dtype)
+
+# ================ 内存推理：不落盘 ================
+def forward(net, x, device="cpu", upsample_align=False, dtype=torch.float32):
+    """BCHW [0,1] 进，BCHW [0,1] 出（已 clip，留在 CPU）"""
+    return forward_model(net, x * 2 - 1, device, upsample_align, dtype).clip(-1, 1) * 0.5 + 0.5
+
+def forward_model(net, x, device="cpu", upsample_align=False, dtype=torch.float32):
+    """模型原始区间：BCHW [-1,1] 进，BCHW float 出（未 clip，留在 CPU），配合 imageops 使用"""
+    with torch.no_grad():
+        return net(x.to(device=device, dtype=dtype), upsample_align).float().cpu()
+
+def restore_size(out, size):
+    """把模型输出双线性拉回原图尺寸，size 为 (h, w)"""
+    if tuple(out.shape[-2:]) == tuple(size):
+        return out
+    return torch.nn.functional.interpolate(out, size=size, mode="bilinear", align_corners=False)
+
+def infer_tensor(x, checkpoint, device="cpu", upsample_align=False, max_edge=1024, dtype=torch.float32,
+                 metrics=NULL_METRICS):
+    """BCHW float [0,1] 进，同尺寸 BCHW [0,1] 出
+
+    张量路径用 F.interpolate(antialias) 缩放，和 PIL LANCZOS 略有差别。
+    """
+    if x.dim() != 4 or x.size(1) != 3:
+        raise ValueError(f"需要 Bx3xHxW 张量，收到 {tuple(x.shape)}")
+    with metrics.timer("load_model"):
+        net = get_model(checkpoint, device, dtype)
+    oh, ow = x.shape[-2:]
+    nw, nh = model_size(ow, oh, max_edge=max_edge, x32=True)
+    src = x.float()
+    with metrics.timer("resize"):
+        if (nw, nh) != (ow, oh):
+            src = torch.nn.functional.interpolate(src, size=(nh, nw), mode="bicubic",
+                                                  align_corners=False, antialias=True).clamp(0, 1)
+    with metrics.timer("forward"):
+        out = forward(net, src, device, upsample_align, dtype)
+    with metrics.timer("postprocess"):
+        return restore_size(out, (oh, ow)).to(x.dtype)
+
+def infer(image, checkpoint, device="cpu", upsample_align=False, max_edge=1024, dtype=torch.float32, fmt="PNG",
+          metrics=NULL_METRICS):
+    """内存推理，输入什么类型就返回什么类型，全程不碰磁盘
+
+    - PIL.Image         → PIL.Image (RGB)
+    - np.ndarray uint8  → HxWx3 uint8；float 数组按 [0,1] 处理，返回 float32
+    - bytes             → 编码后的 bytes（格式由 fmt 指定，默认 PNG）
+    - torch.Tensor BCHW → BCHW [0,1]，见 infer_tensor
+
+    前三种走 imageops 的张量路径：uint8 上抗锯齿缩放，归一化/还原尺寸都不经过 PIL 中间图。
+
+    metrics（metrics.Metrics）记录 load_model / resize / forward / postprocess 各阶段耗时。
+    """
+    if isinstance(image, torch.Tensor):
+        return infer_tensor(image, checkpoint, device, upsample_align, max_edge, dtype, metrics)
+    if isinstance(image, np.ndarray) and image.dtype != np.uint8:
+        arr = image if image.ndim == 3 else np.repeat(image[..., None], 3, axis=2)
+        x = torch.from_numpy(np.ascontiguousarray(arr[..., :3], dtype=np.float32)).permute(2, 0, 1).unsqueeze(0)
+        out = infer_tensor(x, checkpoint, device, upsample_align, max_edge, dtype, metrics)
+        return out.squeeze(0).permute(1, 2, 0).numpy()
+    src = _to_u8(image)
+    with metrics.timer("load_model"):
+        net = get_model(checkpoint, device, dtype)
+    full, _ = stylize_u8(net, src, device, upsample_align, max_edge, dtype, metrics)
+    return _like_input(image, full, fmt)
+
+def stylize_u8(net, src, device="cpu", upsample_align=False, max_edge=1024, dtype=torch.float32,
+               metrics=NULL_METRICS):
+    """已加载的模型 + 3xHxW uint8 → (原图尺寸 3xHxW uint8, 模型分辨率 3xhxw uint8)
+
+    调用方自己持有模型、自己解码（如 GUI 作业预取好的图）时用，省掉 get_model 查表和重复解码。
+    """
+    h, w = src.shape[-2:]
+    with metrics.timer("resize"):
+        x = imageops.preprocess([src], model_size(w, h, max_edge=max_edge, x32=True))
+    with metrics.timer("forward"):
+        out = forward_model(net, x, device, upsample_align, dtype)
+    with metrics.timer("postprocess"):
+        (full,), small = imageops.postprocess(out, [(h, w)])
+        return full, small[0]
+
+def _to_u8(image):
+    """PIL / uint8 数组 / 编码字节 → 3xHxW uint8 张量"""
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return imageops.decode(bytes(image))
+    if isinstance(image, np.ndarray):
+        arr = image if image.ndim == 3 else np.repeat(image[..., None], 3, axis=2)
+        return torch.from_numpy(np.ascontiguousarray(arr[..., :3])).permute(2, 0, 1)
+    return torch.from_numpy(np.array(image.convert("RGB"))).permute(2, 0, 1)
+
+def _like_input(image, out, fmt="PNG"):
+    """把 3xHxW uint8 输出转回和输入相同的类型"""
+    if isinstance(image, np.ndarray):
+        return np.ascontiguousarray(out.permute(1, 2, 0).numpy())
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return imageops.encode(out, "." + fmt.lower())
+    return imageops.to_pil(out)
+
+def infer_styles(image, checkpoints, device="cpu", upsample_align=False, max_edge=1024, dtype=torch.float32,
+                 fmt="PNG", workers=None, metrics=NULL_METRICS):
+    """同一张图跑多个风格：解码/缩放/归一化只做一次，各权重在共享的输入张量上前向
+
+    返回 {权重文件名: 输出}，输出类型同 infer（PIL / uint8 数组 / bytes）。
+    workers 为同时前向的风格数，默认按 torch 线程数估计（每个前向至少分到 4 个线程），
+    小激活上的 depthwise 卷积和 GroupNorm 并行度有限，多个前向并发比串行更能吃满多核。
+    """
+    if isinstance(image, torch.Tensor) or (isinstance(image, np.ndarray) and image.dtype != np.uint8):
+        raise TypeError("infer_styles 只接受 PIL.Image / uint8 数组 / bytes")
+    checkpoints = list(checkpoints)
+    src = _to_u8(image)
+    h, w = src.shape[-2:]
+    with metrics.timer("resize"):
+        x = imageops.preprocess([src], model_size(w, h, max_edge=max_edge, x32=True))
+
+    def run(ckpt):
+        with metrics.timer("load_model"):
+            net = get_model(ckpt, device, dtype)
+        with metrics.timer("forward"):
+            out = forward_model(net, x, device, upsample_align, dtype)
+        with metrics.timer("postprocess"):
+            (full,), _ = imageops.postprocess(out, [(h, w)])
+            return _like_input(image, full, fmt)
+
+    if workers is None:
+        workers = max(1, min(len(checkpoints), torch.get_num_threads() // 4))
+    if workers <= 1 or len(checkpoints) <= 1:
+        outs = [run(c) for c in checkpoints]
+    else:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(workers) as pool:
+            outs = list(pool.map(run, checkpoints))
+    return {os.path.basename(str(c)): o for c, o in zip(checkpoints, outs)}
 
 # ================ 新增：供 GUI 直接调用 ================
 def run_infer(checkpoint: str, input_dir: str, output_dir: str,
-              device: str = 'cpu', upsample_align: bool = False):
-    import os, pathlib, time
-    # print(f'[CLOUD-LOG] 开始推理 | checkpoint={checkpoint}')
-    # print(f'[CLOUD-LOG] 输入目录={input_dir} 输出目录={output_dir} device={device}')
+              device: str = 'cpu', upsample_align: bool = False,
+              batch_size: int = 1, max_batch_pixels: int = 2 * 1024 * 1024,
+              decode_workers: int = 0, encode_workers: int = 0,
+              use_cache: bool = True, sync: bool = False, recursive: bool = False,
+              metrics=NULL_METRICS, profile_blocks: bool = False,
+              processes: int = 0, threads_per_process: int = None,
+              faces: bool = False, face_boxes: dict = None, face_background: str = None):
+    logger.info("开始推理 | checkpoint=%s", checkpoint)
+    logger.info("输入目录=%s 输出目录=%s device=%s", input_dir, output_dir, device)
+
+    # --- 人脸模式：只跑人脸裁剪（face_paint / celeba_distill），底图保留原图或用 face_background 低分辨率跑 ---
+    # 逐张单独处理，不走结果缓存（use_cache 无效），不支持 sync / processes / profile_blocks
+    if faces:
+        unsupported = [name for name, on in (("sync", sync), ("processes", processes),
+                                             ("profile_blocks", profile_blocks)) if on]
+        if unsupported:
+            raise ValueError(f"faces=True 不支持 {', '.join(unsupported)}")
+        from faces import convert_dir_faces
+        try:
+            convert_dir_faces(checkpoint, input_dir, output_dir, device, upsample_align, boxes=face_boxes,
+                              background=face_background, recursive=recursive, metrics=metrics)
+        except Exception as e:
+            logger.exception("人脸模式失败 | 权重路径=%s", checkpoint)
+            metrics.event(status="failed", stage="faces", path=checkpoint, error=repr(e))
+        finally:
+            metrics.flush()
+        logger.info("全部完成")
+        return
 
     # --- 加载模型 ---
     try:
-        net = Generator()
-        # print(f'[CLOUD-LOG] Generator 创建成功')
-        sd = torch.load(checkpoint, map_location="cpu")
-        net.load_state_dict(sd)
-        net.to(device).eval()
-        # print(f'[CLOUD-LOG] 模型加载完成 | 权重路径={checkpoint}')
+        with metrics.timer("load_model"):
+            net = get_model(checkpoint, device)
+        logger.info("模型加载完成 | 权重路径=%s", checkpoint)
     except Exception as e:
-        # print(f'[CLOUD-LOG] 模型加载失败 | 错误={e}')
+        logger.exception("模型加载失败 | 权重路径=%s", checkpoint)
+        metrics.event(status="failed", stage="load_model", path=checkpoint, error=repr(e))
+        metrics.flush()
         return          # ← 这里提前退出，不会生成任何图
 
-    # --- 处理单张图（你原来的逻辑） ---
-    os.makedirs(output_dir, exist_ok=True)
-    for image_name in sorted(os.listdir(input_dir)):
-        if image_name.lower().endswith(('.jpg', '.jpeg', '.png', '.bmp', '.tiff')):
-            image_path = os.path.join(input_dir, image_name)
-            img, (ow, oh) = load_image(image_path, max_edge=1024, x32=True)
-            with torch.no_grad():
-                x = to_tensor(img).unsqueeze(0) * 2 - 1
-                out = net(x.to(device), upsample_align).cpu()
-                out = out.squeeze(0).clip(-1, 1) * 0.5 + 0.5
-                out = torch.nn.functional.interpolate(
-                    out.unsqueeze(0), size=(oh, ow), mode="bilinear", align_corners=False
-                ).squeeze(0)
-                out_img = to_pil_image(out)
-            out_img.save(os.path.join(output_dir, image_name))
-            # print(f'[CLOUD-LOG] 已生成 {image_name}')
-        else:
-            pass
-    #         print(f'[CLOUD-LOG] 跳过非图片文件 {image_name}')
-    # print('[CLOUD-LOG] 全部完成')
+    # --- 先查结果缓存，未命中的按尺寸分桶批量推理，非图片文件直接跳过 ---
+    cache = None
+    if use_cache:
+        from result_cache import get_cache
+        cache = get_cache()
+    manifest = None
+    if sync:
+        from manifest import open_manifest
+        manifest = open_manifest(output_dir, checkpoint, upsample_align)
+    # profile_blocks 会在共享的注册表模型上挂 hook，只在本次调用期间生效；多进程时 hook 不随模型过去
+    hooks = attach_block_hooks(net, metrics) if profile_blocks and not processes else []
+    try:
+        convert_dir(net, input_dir, output_dir, device, upsample_align,
+                    batch_size=batch_size, max_batch_pixels=max_batch_pixels,
+                    decode_workers=decode_workers, encode_workers=encode_workers,
+                    cache=cache, checkpoint=checkpoint, recursive=recursive, manifest=manifest,
+                    metrics=metrics, processes=processes, threads_per_process=threads_per_process)
+    finally:
+        for h in hooks:
+            h.remove()
+        metrics.flush()
+    logger.info("全部完成")
+
 
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, default='./weights/paprika.pt')
+    parser.add_argument('--input_dir', type=str, default='./samples/inputs')
+    parser.add_argument('--output_dir', type=str, default='./samples/results')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--upsample_align', action='store_true')
+    parser.add_argument('--batch-size', type=int, default=1,
+                        help='同尺寸图片合批推理的最大张数')
+    parser.add_argument('--max-batch-pixels', type=int, default=2 * 1024 * 1024,
+                        help='单批输入像素总数上限（控制峰值内存）')
+    parser.add_argument('--decode-workers', type=int, default=0,
+                        help='解码线程数，>0 时启用流水线')
+    parser.add_argument('--encode-workers', type=int, default=0,
+                        help='编码/保存线程数，>0 时启用流水线')
+    parser.add_argument('--processes', type=str, default='0',
+                        help='多进程推理的进程数，auto 为先测速再选；0 为单进程')
+    parser.add_argument('--threads-per-process', type=int, default=None,
+                        help='每个进程的 torch 线程数，默认 核数/进程数')
+    parser.add_argument('--optimize', action='store_true',
+                        help='使用 optimize.py 融合后的推理模型（数值与原模型一致）')
+    parser.add_argument('--precision', choices=['fp32', 'bf16', 'int8', 'int8-dynamic'], default='fp32',
+                        help='CPU 推理精度，int8 需配合 --calib_dir；画质对比见 precision.py')
+    parser.add_argument('--calib_dir', type=str, default=None, help='int8 静态量化的校准图片目录')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='不读写结果缓存（默认在 ./cache，可用 ANIMEGAN_CACHE_DIR 指定）')
+    parser.add_argument('--sync', action='store_true',
+                        help='增量同步：按 output_dir 里的清单跳过未变化的图，可断点续跑')
+    parser.add_argument('--recursive', action='store_true',
+                        help='递归子目录，输出保持相同目录结构')
+    parser.add_argument('--tiled', action='store_true',
+                        help='全分辨率分块推理，不再缩到 1024；不读写结果缓存，不支持 --sync/--processes/--precision/--optimize')
+    parser.add_argument('--tile-budget-mb', type=int, default=1024,
+                        help='分块推理的内存预算（tile 激活 + 一行 tile 的拼接缓冲），决定 tile 大小')
+    parser.add_argument('--tile-norm', choices=['global', 'tile'], default='global',
+                        help='global: 低分辨率整图统计 GroupNorm 后各块复用；tile: 每块各算')
+    parser.add_argument('--faces', action='store_true',
+                        help='人脸模式：只把人脸裁剪按模型原生分辨率（face_paint 512 / celeba 256）跑一批再贴回；'
+                             '不读写结果缓存，不支持 --sync/--processes/--precision/--optimize')
+    parser.add_argument('--face-boxes', type=str, default=None,
+                        help='人脸框 JSON {文件名: [[x0,y0,x1,y1],...]}，未列出的图用 OpenCV 自动检测')
+    parser.add_argument('--face-background', type=str, default=None,
+                        help='人脸模式的底图权重（如 weights/paprika.pt），默认保留原照片')
+    parser.add_argument('--face-bg-edge', type=int, default=512, help='底图的处理分辨率（长边）')
+    parser.add_argument('--metrics-log', action='store_true',
+                        help='以 key=value 结构化日志输出每张失败图和最终各阶段耗时/计数')
+    parser.add_argument('--metrics-prom', type=str, default=None,
+                        help='结束时把计数和各阶段耗时写成 Prometheus 文本格式到该文件')
+    parser.add_argument('--profile-blocks', action='store_true',
+                        help='给 Generator 各 block 挂计时 hook（block.<name>）')
+    args = parser.parse_args()
+    import logging
+    logging.basicConfig(level=logging.INFO if args.metrics_log else logging.WARNING,
+                        format="%(asctime)s %(levelname)s %(name)s %(message)s")
+    test(args)
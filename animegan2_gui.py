@@ -3,7 +3,8 @@
 """
 AnimeGAN2 - 背景主题切换 | 左中右 | 零闪退
 """
-import sys, pathlib, datetime, tempfile, shutil
+import sys, io, os, pathlib, datetime
+from collections import Counter
 from PIL import Image
 from PyQt5.QtWidgets import *
 from PyQt5.QtCore import *
@@ -12,6 +13,10 @@ from PyQt5.QtGui import *
 # ----------- 配置 -----------
 WEIGHTS_DIR = pathlib.Path(__file__).parent / "weights"
 IMAGE_EXTS  = {".jpg", ".jpeg", ".png", ".bmp", ".tiff"}
+MAX_EDGE    = 1024                                   # 处理分辨率（长边）上限
+PREVIEW_EDGE = 512                                   # 右侧预览图长边
+# 单张目标耗时（秒），设了才会在慢机器上自动降低处理分辨率；默认不限，始终按 MAX_EDGE
+TARGET_S    = float(os.environ["ANIMEGAN_TARGET_S"]) if os.environ.get("ANIMEGAN_TARGET_S") else None
 
 CHINESE_MAP = {
     "face_paint_512_v1.pt": "FacePaint 512 V1（人像尝鲜，笔触更粗）",
@@ -36,47 +41,209 @@ def make_out_dir():
     sub.mkdir(exist_ok=True)
     return sub
 
+def out_stems(files):
+    """每张输入 → 输出的相对路径前缀（不含风格后缀和扩展名），保证同一作业里互不覆盖
+
+    按所有输入的公共上级目录保持子目录结构（a/1.jpg、b/1.jpg 分别进 a/、b/）；
+    同一目录下只差扩展名的（x.jpg / x.png）再带上原扩展名。
+    """
+    if not files:
+        return {}
+    root = pathlib.Path(os.path.commonpath([str(f.parent) for f in files]))
+    rel = {f: f.parent.relative_to(root) / f.stem for f in files}
+    counts = Counter(rel.values())
+    return {f: r.with_name(f"{r.name}_{f.suffix.lstrip('.')}") if counts[r] > 1 else r for f, r in rel.items()}
+
 # ----------- 线程：直接调用函数，无子进程 -----------
-from anime_infer import run_infer   # ★ 关键导入
+import contextlib
+from anime_infer import infer_styles, preload_models, get_model, stylize_u8   # ★ 关键导入
+import imageops
+from jobs import JobControl, Throughput, format_eta, prefetch
+from result_cache import get_cache, make_policy
+from scheduler import ResolutionScheduler
+from metrics import Metrics, CallbackSink
+from server import server_url, stylize_remote
+
+def _qimage(img: Image.Image) -> QImage:
+    """PIL → 自己持有数据的 QImage；在工作线程里转好再发给界面线程，界面线程只管贴图"""
+    rgb = img.convert("RGB")
+    return QImage(rgb.tobytes(), rgb.width, rgb.height, rgb.width * 3, QImage.Format_RGB888).copy()
+
+def _load(file):
+    """预取：读文件 + 解码成 3xHxW uint8"""
+    data = file.read_bytes()
+    return data, imageops.decode(data)
 
 class ConvertThread(QThread):
+    """一次转换作业：模型整个作业只取一次，后台预取解码后面的图
+
+    每张图之间可以暂停/取消；结果直接存进 out_dir（{原名}_{风格}.png，子目录结构和重名处理见 out_stems），
+    预览图在本线程缩好转成 QImage，进度/速度/剩余时间通过信号推给界面。
+    """
     log    = pyqtSignal(str)
     prog   = pyqtSignal(int)
-    finished_one = pyqtSignal(object)
+    finished_one = pyqtSignal(QImage, str)        # 预览图, 保存路径
+    stats  = pyqtSignal(int, int, float, float)   # 已完成, 总数, 张/秒, 剩余秒数（未知为 -1）
 
-    def __init__(self, files, model, device):
+    def __init__(self, files, model, device, all_models=None, out_dir=None, scheduler=None):
         super().__init__()
         self.files, self.model, self.device = files, model, device
+        self.sched = scheduler or ResolutionScheduler(target_s=None, max_edge=MAX_EDGE)
+        # all_models 非空时为多风格模式：每张图解码一次跑全部风格
+        self.all_models = all_models
+        self.out_dir = pathlib.Path(out_dir) if out_dir else make_out_dir()
+        self.stems = out_stems(files)
+        self.control = JobControl()
+        self.cache = get_cache()
+        # 失败事件和结束时的各阶段耗时/计数直接进实时日志
+        self.metrics = Metrics([CallbackSink(self._on_event, self._on_summary)])
+
+    # ---- 界面线程调用：当前这张做完才生效 ----
+    def pause(self):
+        self.control.pause()
+        self.log.emit("⏸ 当前这张完成后暂停")
+
+    def resume(self):
+        self.control.resume()
+        self.log.emit("▶ 继续")
+
+    def cancel(self):
+        self.control.cancel()
+        self.log.emit("⏹ 当前这张完成后停止")
+
+    def _on_event(self, ev):
+        self.log.emit(f"  ✘ {ev.get('path', '')}: {ev.get('error', '')}")
+
+    def _on_summary(self, snap):
+        c = snap["counters"]
+        self.log.emit(f"完成 {c.get('processed', 0)} 张，缓存 {c.get('cached', 0)} 张，失败 {c.get('failed', 0)} 张")
+        for name, t in snap["timings"].items():
+            self.log.emit(f"  {name}: {t['seconds'] * 1000 / max(t['count'], 1):.0f} ms/次 × {t['count']}")
+
+    def _out_path(self, file, model):
+        stem = self.stems[file]
+        path = self.out_dir / stem.parent / f"{stem.name}_{model.stem}.png"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def _plan(self, u8, count=1):
+        """按目标耗时挑这张图的处理分辨率，写进日志"""
+        plan = self.sched.plan(u8.shape[-1], u8.shape[-2], count=count)
+        self.log.emit(f"  处理分辨率 {plan}" + ("（为赶目标耗时已降低）" if plan.degraded else ""))
+        return plan
+
+    def _run_styles(self, file, data, u8):
+        plan = self._plan(u8, len(self.all_models))
+        policy = make_policy(plan.max_edge)
+        keys = {m: self.cache.make_key(data, str(m), policy, False) for m in self.all_models}
+        outs = {}
+        for m, k in keys.items():
+            hit = self.cache.get(k)
+            if hit is not None:
+                outs[m] = Image.open(io.BytesIO(hit)).convert("RGB")
+                self.metrics.inc("cached")
+        todo = [m for m in self.all_models if m not in outs]
+        if todo:
+            # 预取好的张量直接以 HxWx3 视图交给 infer_styles，不再解码一次
+            with self.sched.track(plan.size, count=len(todo)):
+                res = infer_styles(u8.permute(1, 2, 0).numpy(), [str(m) for m in todo], device=self.device,
+                                   max_edge=plan.max_edge, metrics=self.metrics)
+            for m in todo:
+                outs[m] = Image.fromarray(res[m.name])
+                buf = io.BytesIO(); outs[m].save(buf, format="PNG")
+                self.cache.put(keys[m], buf.getvalue())
+                self.metrics.inc("processed")
+        with self.metrics.timer("save"):
+            for m, img in outs.items():
+                img.save(self._out_path(file, m))
+        grid = _grid([outs[m] for m in self.all_models])
+        grid.thumbnail((PREVIEW_EDGE, PREVIEW_EDGE), Image.LANCZOS)
+        return grid, str(self._out_path(file, self.all_models[0]))
+
+    def _run_one(self, file, data, u8, net):
+        # ★ 先查结果缓存；未命中再用作业持有的模型推理
+        remote = server_url()
+        # 走推理服务时分辨率由服务端按负载定，这里只按满分辨率查缓存
+        plan = None if remote else self._plan(u8)
+        edge = plan.max_edge if plan else MAX_EDGE
+        key = self.cache.make_key(data, str(self.model), make_policy(edge), False)
+        hit = self.cache.get(key)
+        if hit is not None:
+            png, small = hit, imageops.decode(hit)
+            self.metrics.inc("cached")
+            self.log.emit("  ✔ 命中结果缓存")
+        elif remote:
+            # 设了 ANIMEGAN_SERVER 时交给推理服务
+            with self.metrics.timer("remote"):
+                png, info = stylize_remote(data, self.model.name, with_info=True)
+            small = imageops.decode(png)
+            self.log.emit(f"  服务端处理分辨率 {info['resolution']}" + ("（服务繁忙已降低）" if info["degraded"] else ""))
+            if not info["degraded"]:
+                self.cache.put(key, png)
+            self.metrics.inc("processed")
+        else:
+            with self.sched.track(plan.size):
+                full, small = stylize_u8(net, u8, self.device, max_edge=plan.max_edge, metrics=self.metrics)
+            with self.metrics.timer("encode"):
+                png = imageops.encode(full, ".png")
+            self.cache.put(key, png)
+            self.metrics.inc("processed")
+        out_path = self._out_path(file, self.model)
+        with self.metrics.timer("save"):
+            out_path.write_bytes(png)
+        # 预览从模型分辨率的输出缩出，不经过全尺寸结果
+        return imageops.thumbnail(small, PREVIEW_EDGE), str(out_path)
 
     def run(self):
-        for idx, file in enumerate(self.files, 1):
-            self.log.emit(f"[{idx}/{len(self.files)}] {file.name}")
-            temp_dir = pathlib.Path(tempfile.mkdtemp(prefix="animegan_"))
-            temp_file = temp_dir / file.name
+        net = None
+        if not self.all_models and not server_url():
             try:
-                Image.open(file).save(temp_file)
-                # ★ 直接调用函数，不再起任何进程
-                run_infer(
-                    checkpoint=str(self.model),
-                    input_dir=str(temp_dir),
-                    output_dir=str(temp_dir),
-                    device=self.device
-                )
-                out_file = temp_dir / file.name
-                if out_file.exists():
-                    with Image.open(out_file) as img:
-                        img = img.convert("RGB")
-                        img.thumbnail((512, 512), Image.LANCZOS)
-                        self.finished_one.emit(img.copy())
-                    self.log.emit("  ✔ 生成图预览已更新")
-                else:
-                    self.log.emit("  ✘ 未找到生成图")
+                with self.metrics.timer("load_model"):
+                    net = get_model(str(self.model), self.device)
             except Exception as e:
-                self.log.emit(f"  ✘ 线程异常: {e}")
-            finally:
-                shutil.rmtree(temp_dir, ignore_errors=True)
-                self.prog.emit(idx)
-        self.log.emit("=== 全部完成 ===")
+                self.log.emit(f"✘ 模型加载失败 {self.model.name}: {e}")
+                return
+        self.out_dir.mkdir(parents=True, exist_ok=True)
+        tp = Throughput(len(self.files), self.control)
+        total = len(self.files)
+        with contextlib.closing(prefetch(self.files, _load)) as items:
+            for idx, (file, loaded, err) in enumerate(items, 1):
+                if not self.control.wait():
+                    self.log.emit(f"=== 已取消，剩余 {total - idx + 1} 张未处理 ===")
+                    break
+                self.log.emit(f"[{idx}/{total}] {file.name}")
+                ok = False
+                try:
+                    if err is not None:
+                        raise err
+                    data, u8 = loaded
+                    if self.all_models:
+                        img, path = self._run_styles(file, data, u8)
+                    else:
+                        img, path = self._run_one(file, data, u8, net)
+                    self.finished_one.emit(_qimage(img), path)
+                    self.log.emit(f"  ✔ 已保存 {path}")
+                    ok = True
+                except Exception as e:
+                    self.metrics.inc("failed")
+                    self.metrics.event(status="failed", path=file.name, error=e)
+                finally:
+                    p = tp.tick(ok)
+                    self.prog.emit(idx)
+                    self.stats.emit(p.done, p.total, p.rate, p.eta_s)
+            else:
+                self.log.emit("=== 全部完成 ===")
+        self.metrics.flush()
+
+
+def _grid(images, cols=2):
+    """多风格结果拼成网格预览，每格按第一张的尺寸"""
+    w, h = images[0].size
+    rows = (len(images) + cols - 1) // cols
+    sheet = Image.new("RGB", (w * min(cols, len(images)), h * rows))
+    for i, img in enumerate(images):
+        sheet.paste(img.resize((w, h)), ((i % cols) * w, (i // cols) * h))
+    return sheet
 
 
 # ================== 以下 UI 代码与原文件相同 ==================
@@ -89,8 +256,12 @@ class MainWindow(QMainWindow):
         self.models = scan_models()
         if not self.models:
             QMessageBox.warning(self, "提示", f"请把 .pt 权重放到\n{WEIGHTS_DIR}\n再重启"); sys.exit()
+        preload_models(WEIGHTS_DIR, background=True)
+        self.sched = ResolutionScheduler(target_s=TARGET_S, max_edge=MAX_EDGE)
+        if TARGET_S is not None:
+            self.sched.calibrate_async(lambda: get_model(str(self.models[0])))
         self.out_dir = make_out_dir()
-        self.current_img = None
+        self.current_path = None
         self.thread = None
         self._init_ui()
 
@@ -114,6 +285,7 @@ class MainWindow(QMainWindow):
         self.dst_lbl = QLabel("暂无生成图"); self.dst_lbl.setAlignment(Qt.AlignCenter); self.dst_lbl.setMinimumSize(400, 300); self.dst_lbl.setStyleSheet("border:1px solid #555")
         v.addWidget(self.dst_lbl, alignment=Qt.AlignHCenter)
         self.bar = QProgressBar(); v.addWidget(self.bar)
+        self.speed_lbl = QLabel("就绪"); v.addWidget(self.speed_lbl)
         self.log_te = QTextEdit(); self.log_te.setMaximumHeight(120)
         v.addWidget(QLabel("实时日志:")); v.addWidget(self.log_te)
         grid.addWidget(mid_gb, 0, 1)
@@ -127,12 +299,17 @@ class MainWindow(QMainWindow):
         v.addWidget(self.model_cb)
         v.addWidget(QLabel("设备:"))
         self.dev_cb = QComboBox(); self.dev_cb.addItems(["cpu", "cuda:0"]); v.addWidget(self.dev_cb)
+        self.all_cb = QCheckBox("全部风格对比（每张图只解码一次）"); v.addWidget(self.all_cb)
         v.addWidget(QLabel("下载目录:"))
         self.out_lbl = QLabel(str(self.out_dir)); self.out_lbl.setWordWrap(True); v.addWidget(self.out_lbl)
         choose_btn = QPushButton("更改目录"); choose_btn.clicked.connect(self._choose_out); v.addWidget(choose_btn)
         v.addStretch()
         down_btn = QPushButton("开始下载"); down_btn.clicked.connect(self._download); v.addWidget(down_btn)
         start_btn = QPushButton("开始转换"); start_btn.clicked.connect(self._start); v.addWidget(start_btn)
+        self.start_btn = start_btn
+        self.pause_btn = QPushButton("暂停"); self.pause_btn.clicked.connect(self._toggle_pause); v.addWidget(self.pause_btn)
+        self.cancel_btn = QPushButton("取消"); self.cancel_btn.clicked.connect(self._cancel); v.addWidget(self.cancel_btn)
+        self.pause_btn.setEnabled(False); self.cancel_btn.setEnabled(False)
 
         theme_lbl = QLabel("主题:")
         self.theme_cb = QComboBox()
@@ -193,39 +370,66 @@ class MainWindow(QMainWindow):
     def _show_src(self, file: pathlib.Path):
         self.src_lbl.setPixmap(QPixmap(str(file)).scaled(400, 300, Qt.KeepAspectRatio, Qt.SmoothTransformation))
 
-    def _show_dst(self, img: Image.Image):
-        self.current_img = img
-        self.log_te.append(f">>> 收到生成图: {img.format} {img.size} mode={img.mode}")
-        rgb = img.convert("RGB"); data = rgb.tobytes()
-        qimg = QImage(data, rgb.width, rgb.height, QImage.Format_RGB888)
-        pixmap = QPixmap.fromImage(qimg).scaled(400, 300, Qt.KeepAspectRatio, Qt.FastTransformation)
+    def _show_dst(self, qimg: QImage, path: str):
+        # 预览图已在工作线程缩好并转成 QImage，这里只贴图
+        self.current_path = path
+        pixmap = QPixmap.fromImage(qimg).scaled(400, 300, Qt.KeepAspectRatio, Qt.SmoothTransformation)
         self.dst_lbl.setPixmap(pixmap)
         self.dst_lbl.update()
-        self.log_te.append(">>> 生成图已刷新（Fast）")
+
+    def _show_stats(self, done, total, rate, eta):
+        self.speed_lbl.setText(f"{done}/{total} · {rate:.2f} 张/秒 · 剩余 {format_eta(eta)}")
 
     def _download(self):
-        if self.current_img is None:
+        if self.current_path is None:
             QMessageBox.information(self, "提示", "尚未生成图片，请先转换！"); return
-        save_path, _ = QFileDialog.getSaveFileName(self, "保存生成图", str(self.out_dir / "anime.png"),
+        save_path, _ = QFileDialog.getSaveFileName(self, "保存生成图", str(self.out_dir / pathlib.Path(self.current_path).name),
                                                    "PNG (*.png);;JPEG (*.jpg);;BMP (*.bmp)")
         if save_path:
-            self.current_img.save(save_path)
+            Image.open(self.current_path).convert("RGB").save(save_path)
             self.log_te.append(f"✔ 已保存到: {save_path}")
 
+    def _toggle_pause(self):
+        if self.thread is None: return
+        if self.thread.control.paused:
+            self.thread.resume(); self.pause_btn.setText("暂停")
+        else:
+            self.thread.pause(); self.pause_btn.setText("继续")
+
+    def _cancel(self):
+        if self.thread is not None:
+            self.thread.cancel()
+            self.cancel_btn.setEnabled(False)
+
+    def _job_done(self):
+        self.start_btn.setEnabled(True)
+        self.pause_btn.setEnabled(False); self.pause_btn.setText("暂停")
+        self.cancel_btn.setEnabled(False)
+
     def _start(self):
         if self.list_w.count() == 0:
             QMessageBox.warning(self, "提示", "列表为空！"); return
         files = [pathlib.Path(self.list_w.item(i).text()) for i in range(self.list_w.count())]
-        self.thread = ConvertThread(files, self.models[self.model_cb.currentIndex()], self.dev_cb.currentText())
+        self.thread = ConvertThread(files, self.models[self.model_cb.currentIndex()], self.dev_cb.currentText(),
+                                    all_models=self.models if self.all_cb.isChecked() else None,
+                                    out_dir=self.out_dir, scheduler=self.sched)
         self.thread.log.connect(self.log_te.append)
         self.thread.prog.connect(self.bar.setValue)
-        self.bar.setMaximum(len(files))
-        start_btn = self.sender() or [b for b in self.findChildren(QPushButton) if b.text() == "开始转换"][0]
-        start_btn.setEnabled(False)
-        self.thread.finished.connect(lambda: start_btn.setEnabled(True))
+        self.thread.stats.connect(self._show_stats)
+        self.bar.setMaximum(len(files)); self.bar.setValue(0)
+        self.speed_lbl.setText(f"0/{len(files)} · 预取中…")
+        self.start_btn.setEnabled(False)
+        self.pause_btn.setEnabled(True); self.cancel_btn.setEnabled(True)
+        self.thread.finished.connect(self._job_done)
         self.thread.finished_one.connect(self._show_dst)
         self.thread.start()
 
+    def closeEvent(self, event):
+        # 关窗时让作业在当前这张之后停下，避免线程还在写文件时进程退出
+        if self.thread is not None and self.thread.isRunning():
+            self.thread.cancel()
+            self.thread.wait()
+        super().closeEvent(event)
 
 if __name__ == '__main__':
     import traceback
@@ -1,10 +1,17 @@
 # app.py  清爽·极速版
 import streamlit as st
-import pathlib
 import torch
 import PIL.Image
 import io
-from anime_infer import run_infer
+import os
+from anime_infer import infer, infer_styles, preload_models, get_model, model_size
+from result_cache import get_cache, make_policy
+from scheduler import ResolutionScheduler
+from server import server_url, stylize_remote
+
+# 空闲时的处理/输出分辨率（长边），以及单次处理的目标耗时（秒），忙时自动降分辨率赶这个目标
+MAX_EDGE = 720
+TARGET_S = float(os.environ.get("ANIMEGAN_TARGET_S", 3))
 
 # ----------- 页面美化 -----------
 st.set_page_config(page_title="XuのAnimeGAN2", page_icon="🎨", layout="centered")
@@ -14,10 +21,9 @@ with st.sidebar:
     st.markdown("上传真人照片，3~8 秒生成动漫风格。")
 
     # ① 模型选择
-    model_name = st.selectbox(
-        "选择风格模型",
-        ["face_paint_512_v2.pt", "face_paint_512_v1.pt", "celeba_distill.pt", "paprika.pt"]
-    )
+    MODELS = ["face_paint_512_v2.pt", "face_paint_512_v1.pt", "celeba_distill.pt", "paprika.pt"]
+    model_name = st.selectbox("选择风格模型", MODELS)
+    compare_all = st.checkbox("四种风格一起出图（只解码一次）")
 
     # ② 中文解释（动态更新）
     desc = {
@@ -31,42 +37,144 @@ with st.sidebar:
     # ③ 设备选择
     device = st.radio("运行设备", ["cpu", "cuda"], disabled=not torch.cuda.is_available())
 
+# ----------- 启动时在后台预加载全部权重（整个进程只做一次，不挡首屏） -----------
+@st.cache_resource(show_spinner=False)
+def _preload(device: str):
+    return preload_models("weights", device=device, background=True)
+
+_preload(device)
+
+# ----------- 分辨率调度器：全进程共用（各会话的请求一起算负载），后台标定单价 -----------
+@st.cache_resource(show_spinner=False)
+def _scheduler(device: str):
+    sched = ResolutionScheduler(target_s=TARGET_S, max_edge=MAX_EDGE)
+    sched.calibrate_async(lambda: get_model(f"weights/{MODELS[0]}", device), device)
+    return sched
+
+sched = _scheduler(device)
+
 # ----------- 缓存推理函数（同图2秒内返回） -----------
-@st.cache_data(show_spinner=False)
-def _run_anime(img_bytes: bytes, model: str, device: str) -> bytes:
-    """缓存+压缩：输入原始字节，返回动漫化图片字节"""
-    tmp = pathlib.Path("tmp")
-    tmp.mkdir(exist_ok=True)
-    inp = tmp / "in.png"
-    out = tmp / "in.png"
-
-    # ① 打开即压缩到 720p，保持比例
+def _policy(edge: int) -> str:
+    # 先压缩到 edge 再推理，输出停在压缩后的尺寸
+    return make_policy(edge, full_size=False)
+
+def _thumb(img_bytes: bytes, edge: int):
+    """打开即按处理分辨率压缩，保持比例"""
     img = PIL.Image.open(io.BytesIO(img_bytes)).convert("RGB")
-    img.thumbnail((720, 720), PIL.Image.LANCZOS)   # 网络传输↓70%
-    img.save(inp, quality=85)                      # 再压质量
+    img.thumbnail((edge, edge), PIL.Image.LANCZOS)   # 网络传输↓70%
+    return img
+
+def _png(img) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
 
-    # ② 推理（无 print，页面干净）
-    run_infer(checkpoint=f"weights/{model}",
-              input_dir=str(tmp),
-              output_dir=str(tmp),
-              device=device,
-              upsample_align=False)
+@st.cache_data(show_spinner=False)
+def _run_anime(img_bytes: bytes, model: str, device: str, edge: int, _sched=None) -> bytes:
+    """缓存+压缩：输入原始字节，按调度器选的长边 edge 处理，返回动漫化图片字节"""
+    # ⓪ 先查磁盘结果缓存（重启不丢，和 GUI / 命令行共用）；分辨率是键的一部分，降级结果不会冒充满分辨率
+    cache = get_cache()
+    key = cache.make_key(img_bytes, f"weights/{model}", _policy(edge), False)
+    hit = cache.get(key)
+    if hit is not None:
+        return hit
+
+    # ① 压缩到 edge，② 本进程推理，模型常驻内存；处理期间计入调度器负载
+    img = _thumb(img_bytes, edge)
+    with _sched.track(model_size(*img.size, max_edge=edge)):
+        out = infer(img, checkpoint=f"weights/{model}", device=device, upsample_align=False, max_edge=edge)
+    data = _png(out)
 
     # ③ 返回字节
-    return out.read_bytes()
+    cache.put(key, data)
+    return data
+
+def _run_remote(img_bytes: bytes, model: str) -> tuple:
+    """交给推理服务（多用户共享合批，分辨率由服务端按负载决定），返回 (图片字节, 分辨率)
+
+    不走 st.cache_data：服务忙时的降级结果不能一直留着；只有满分辨率的结果进磁盘缓存。
+    """
+    cache = get_cache()
+    key = cache.make_key(img_bytes, f"weights/{model}", _policy(MAX_EDGE), False)
+    hit = cache.get(key)
+    if hit is not None:
+        return hit, None
+    data, info = stylize_remote(_png(_thumb(img_bytes, MAX_EDGE)), model, with_info=True)
+    if not info["degraded"]:
+        cache.put(key, data)
+    return data, info["resolution"]
+
+@st.cache_data(show_spinner=False)
+def _run_all(img_bytes: bytes, models: tuple, device: str, edge: int, _sched=None) -> dict:
+    """多风格：缓存命中的直接用，其余风格共用一次解码+缩放，返回 {模型: 图片字节}"""
+    cache = get_cache()
+    keys = {m: cache.make_key(img_bytes, f"weights/{m}", _policy(edge), False) for m in models}
+    result = {m: cache.get(k) for m, k in keys.items()}
+    todo = [m for m, v in result.items() if v is None]
+    if todo:
+        img = _thumb(img_bytes, edge)
+        with _sched.track(model_size(*img.size, max_edge=edge), count=len(todo)):
+            outs = infer_styles(img, [f"weights/{m}" for m in todo], device=device, max_edge=edge)
+        for m, out in outs.items():
+            data = _png(out)
+            cache.put(keys[m], data)
+            result[m] = data
+    return result
+
+def _run_all_remote(img_bytes: bytes, models: tuple) -> tuple:
+    """多风格走推理服务，返回 ({模型: 图片字节}, {模型: 分辨率})"""
+    results, sizes = {}, {}
+    for m in models:
+        results[m], sizes[m] = _run_remote(img_bytes, m)
+    return results, sizes
+
+def _resolution_note(res, plan=None) -> str:
+    if res is None:
+        return "处理分辨率：缓存结果"
+    note = f"处理分辨率：{res}"
+    if plan is not None and plan.expected_s is not None:
+        note += f"（预计 {plan.expected_s:.1f} 秒）"
+    if plan is not None and plan.degraded:
+        note += "，当前较忙已自动降低，空闲时恢复"
+    return note
 
 # ----------- 主界面 -----------
 st.title("📸 真人变动漫")
 uploaded = st.file_uploader("拖拽或点击上传图片", type=["png", "jpg", "jpeg"])
-if uploaded is not None:
+plan = None
+if uploaded is not None and not server_url():
+    # 按当前负载挑这次的处理分辨率（只读图片头，不解码）
+    plan = sched.plan(*PIL.Image.open(io.BytesIO(uploaded.getvalue())).size, count=len(MODELS) if compare_all else 1)
+if uploaded is not None and compare_all:
+    st.image(uploaded, caption='原图', use_container_width=True)
+    with st.spinner("AI 正在生成四种风格，请稍候…"):
+        if plan is None:
+            results, sizes = _run_all_remote(uploaded.getvalue(), tuple(MODELS))
+            st.caption("；".join(f"{m[:-3]} {_resolution_note(r)}" for m, r in sizes.items()))
+        else:
+            results = _run_all(uploaded.getvalue(), tuple(MODELS), device, plan.max_edge, _sched=sched)
+            st.caption(_resolution_note(str(plan), plan))
+    cols = st.columns(2)
+    for i, (name, data) in enumerate(results.items()):
+        with cols[i % 2]:
+            st.image(data, caption=desc.get(name, name), use_container_width=True)
+            st.download_button(f"⬇️ 下载 {name[:-3]}", data=data,
+                               file_name=f"anime_{name[:-3]}.png", mime="image/png", key=name)
+    st.success("完成！")
+elif uploaded is not None:
     col1, col2 = st.columns(2)
     col1.image(uploaded, caption='原图', use_container_width=True)
 
     # 一键动漫化
     with st.spinner("AI 正在动漫化，请稍候…"):
-        anime_bytes = _run_anime(uploaded.getvalue(), model_name, device)
+        if plan is None:
+            anime_bytes, res = _run_remote(uploaded.getvalue(), model_name)
+        else:
+            anime_bytes = _run_anime(uploaded.getvalue(), model_name, device, plan.max_edge, _sched=sched)
+            res = str(plan)
 
     col2.image(anime_bytes, caption='动漫化', use_container_width=True)
+    col2.caption(_resolution_note(res, plan))
     st.download_button("⬇️ 下载结果", data=anime_bytes,
                       file_name="anime.png", mime="image/png")
     st.success("完成！右侧图片可右键另存。")
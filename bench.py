@@ -0,0 +1,205 @@
+# ================ 基准测试：Generator 分块耗时 + 端到端各阶段耗时 ================
+import io
+import sys
+import json
+import time
+import platform
+import argparse
+import resource
+import statistics
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision.transforms.functional import to_tensor, to_pil_image
+
+import imageops
+from model import Generator
+from metrics import Metrics, attach_block_hooks
+from anime_infer import resize_for_model, forward, restore_size, model_size, forward_model
+
+BLOCKS = ("block_a", "block_b", "block_c", "block_d", "block_e", "out_layer")
+
+
+def peak_rss_mb():
+    """进程启动以来的峰值 RSS（只增不减，所以按配置从小到大跑更有参考意义）"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+
+def make_model(checkpoint=None, seed=0):
+    """有权重就加载，没有就用固定种子随机初始化，离线也能跑"""
+    torch.manual_seed(seed)
+    net = Generator()
+    if checkpoint:
+        net.load_state_dict(torch.load(checkpoint, map_location="cpu"))
+    return net.eval()
+
+
+def synthetic_image(w, h, seed=0):
+    """带平滑结构的随机图，编码体积和真实照片更接近"""
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, (max(h // 16, 1), max(w // 16, 1), 3), dtype=np.uint8)
+    img = Image.fromarray(small).resize((w, h), Image.BICUBIC)
+    noise = rng.integers(-8, 9, (h, w, 3))
+    return Image.fromarray(np.clip(np.asarray(img, dtype=np.int16) + noise, 0, 255).astype(np.uint8))
+
+
+def bench_forward(net, size, batch, threads, align, repeats=3, warmup=1):
+    torch.set_num_threads(threads)
+    x = torch.rand(batch, 3, size, size) * 2 - 1
+    runs = []
+    with torch.no_grad():
+        for i in range(warmup + repeats):
+            # 各 block 计时用 metrics 的 hook，每次前向一份新的 Metrics；总耗时减去各 block 之和即两次插值的耗时
+            metrics = Metrics()
+            handles = attach_block_hooks(net, metrics, BLOCKS)
+            try:
+                t = time.perf_counter()
+                net(x, align)
+                total = time.perf_counter() - t
+            finally:
+                for h in handles:
+                    h.remove()
+            if i >= warmup:
+                timings = metrics.snapshot()["timings"]
+                blocks = {name: timings.get(f"block.{name}", {"seconds": 0.0})["seconds"] for name in BLOCKS}
+                blocks["interpolate"] = max(total - sum(blocks.values()), 0.0)
+                runs.append((total, blocks))
+    total, blocks = sorted(runs, key=lambda r: r[0])[len(runs) // 2]      # 取中位数那次
+    return {
+        "name": "forward", "size": size, "batch": batch, "threads": threads, "align": align,
+        "total": total, "blocks": blocks, "images_per_sec": batch / total,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def _tensor_stages(net, data, align):
+    """convert_batch 的路径：imageops 解码 → uint8 上缩放 → forward → uint8 放大回原图 → 编码"""
+    t0 = time.perf_counter()
+    u8 = imageops.decode(data)
+    h, w = u8.shape[-2:]
+    t1 = time.perf_counter()
+    x = imageops.preprocess([u8], model_size(w, h, max_edge=1024, x32=True))
+    t2 = time.perf_counter()
+    out = forward_model(net, x, "cpu", align)
+    t3 = time.perf_counter()
+    (full,), _ = imageops.postprocess(out, [(h, w)])
+    t4 = time.perf_counter()
+    imageops.encode(full, ".png")
+    t5 = time.perf_counter()
+    return t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4
+
+
+def _pil_stages(net, data, align):
+    """改 imageops 之前的 PIL 路径（LANCZOS 缩放、to_tensor / to_pil_image），留作对照"""
+    t0 = time.perf_counter()
+    img = Image.open(io.BytesIO(data)).convert("RGB")
+    t1 = time.perf_counter()
+    small, (ow, oh) = resize_for_model(img, max_edge=1024, x32=True)
+    x = to_tensor(small).unsqueeze(0)
+    t2 = time.perf_counter()
+    out = forward(net, x, "cpu", align)
+    t3 = time.perf_counter()
+    out_img = to_pil_image(restore_size(out, (oh, ow)).squeeze(0))
+    t4 = time.perf_counter()
+    out_img.save(io.BytesIO(), format="PNG")
+    t5 = time.perf_counter()
+    return t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4
+
+
+def bench_end_to_end(net, size, threads, align, repeats=3, fmt="JPEG", path="tensor"):
+    """模拟 run_infer 单张图：decode → resize → forward → postprocess → encode
+
+    path="tensor" 为 convert_batch 实际走的 imageops 路径（结果名 end_to_end），
+    path="pil" 为旧的 PIL 路径（结果名 end_to_end_pil）。
+    """
+    torch.set_num_threads(threads)
+    buf = io.BytesIO()
+    synthetic_image(size, size * 3 // 4).save(buf, format=fmt, quality=90)
+    data = buf.getvalue()
+    run_once = {"tensor": _tensor_stages, "pil": _pil_stages}[path]
+    stages = {k: [] for k in ("decode", "resize", "forward", "postprocess", "encode")}
+    for _ in range(repeats + 1):
+        for k, dt in zip(stages, run_once(net, data, align)):
+            stages[k].append(dt)
+    med = {k: statistics.median(v[1:]) for k, v in stages.items()}      # 丢掉第一次（预热）
+    total = sum(med.values())
+    return {
+        "name": "end_to_end" if path == "tensor" else "end_to_end_pil",
+        "size": size, "batch": 1, "threads": threads, "align": align,
+        "total": total, "stages": med, "images_per_sec": 1 / total,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def _key(r):
+    return r["name"], r["size"], r["batch"], r["threads"], r["align"]
+
+
+def compare(results, baseline, tolerance=0.1):
+    """和基线逐项比 total，慢超过 tolerance 的记为回归；返回 [(key, 现在, 基线, 比值)]"""
+    base = {_key(r): r for r in baseline["results"]}
+    regressions = []
+    for r in results["results"]:
+        b = base.get(_key(r))
+        if b is None:
+            continue
+        ratio = r["total"] / b["total"]
+        if ratio > 1 + tolerance:
+            regressions.append((_key(r), r["total"], b["total"], ratio))
+    return regressions
+
+
+def run(sizes=(256, 512), batch_sizes=(1,), threads=(torch.get_num_threads(),), aligns=(False, True),
+        repeats=3, checkpoint=None, end_to_end=True):
+    net = make_model(checkpoint)
+    results = []
+    for n in threads:
+        for size in sizes:
+            for batch in batch_sizes:
+                for align in aligns:
+                    results.append(bench_forward(net, size, batch, n, align, repeats))
+            if end_to_end:
+                results.append(bench_end_to_end(net, size, n, False, repeats))
+                results.append(bench_end_to_end(net, size, n, False, repeats, path="pil"))
+    return {
+        "meta": {
+            "torch": torch.__version__, "python": platform.python_version(),
+            "machine": platform.machine(), "processor": platform.processor(),
+            "cpu_threads_default": torch.get_num_threads(),
+            "random_init": checkpoint is None, "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        },
+        "results": results,
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[256, 512])
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1])
+    parser.add_argument('--threads', type=int, nargs='+', default=[torch.get_num_threads()])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--checkpoint', type=str, default=None, help='默认随机初始化权重')
+    parser.add_argument('--no-e2e', action='store_true', help='只测 Generator.forward')
+    parser.add_argument('--output', type=str, default=None, help='结果 JSON 路径')
+    parser.add_argument('--baseline', type=str, default=None, help='与之比较的基线 JSON')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='慢多少比例算回归')
+    args = parser.parse_args()
+
+    res = run(args.sizes, args.batch_sizes, args.threads, repeats=args.repeats,
+              checkpoint=args.checkpoint, end_to_end=not args.no_e2e)
+    for r in res["results"]:
+        parts = r.get("blocks") or r.get("stages")
+        detail = " ".join(f"{k}={v * 1000:.1f}" for k, v in parts.items())
+        print(f"{r['name']:>14} size={r['size']} b={r['batch']} t={r['threads']} align={r['align']}: "
+              f"{r['total'] * 1000:.1f}ms ({r['images_per_sec']:.2f} img/s, rss {r['peak_rss_mb']:.0f}MB) | {detail}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(res, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regs = compare(res, json.load(f), args.tolerance)
+        for key, now, base, ratio in regs:
+            print(f"REGRESSION {key}: {now * 1000:.1f}ms vs {base * 1000:.1f}ms (x{ratio:.2f})")
+        sys.exit(1 if regs else 0)
@@ -0,0 +1,165 @@
+# ================ 人脸模式：只把人脸区域按模型原生分辨率跑一批，羽化贴回 ================
+import os
+import json
+import threading
+
+import torch
+import torch.nn.functional as F
+
+import imageops
+from anime_infer import (get_model, list_images, output_path, forward_model, model_size, _to_u8, _like_input,
+                         _report_failure)
+from metrics import NULL_METRICS, logger
+from tiling import _ramp
+
+# 各权重训练时的人脸裁剪边长；不在表里的按 512
+NATIVE_SIZE = {"face_paint_512_v1": 512, "face_paint_512_v2": 512, "celeba_distill": 256}
+
+_local = threading.local()
+
+
+def native_size(checkpoint, default=512):
+    return NATIVE_SIZE.get(os.path.splitext(os.path.basename(str(checkpoint)))[0], default)
+
+
+# ---------- 检测：OpenCV Haar 级联（可选依赖），没装时只能手动给框 ----------
+def _cascade():
+    c = getattr(_local, "cascade", None)
+    if c is None:
+        try:
+            import cv2
+        except ImportError:
+            raise RuntimeError("人脸检测需要 opencv（pip install opencv-python-headless），"
+                               "或用 boxes / --face-boxes 直接给出人脸框") from None
+        c = _local.cascade = cv2.CascadeClassifier(cv2.data.haarcascades + "haarcascade_frontalface_default.xml")
+    return c
+
+
+def detect_faces(u8, max_side=640, min_face=24):
+    """3xHxW uint8 → [(x0, y0, x1, y1)] 原图坐标的人脸框
+
+    先缩到长边 max_side 的灰度图再检测，检测耗时与原图大小无关。
+    """
+    h, w = u8.shape[-2:]
+    scale = min(max_side / max(h, w), 1.0)
+    x = u8.unsqueeze(0).float()
+    if scale < 1:
+        x = F.interpolate(x, size=(round(h * scale), round(w * scale)), mode="bilinear",
+                          align_corners=False, antialias=True)
+    gray = (x[0, 0] * 0.299 + x[0, 1] * 0.587 + x[0, 2] * 0.114).round().clamp(0, 255).to(torch.uint8)
+    found = _cascade().detectMultiScale(gray.numpy(), scaleFactor=1.1, minNeighbors=5,
+                                        minSize=(min_face, min_face))
+    return [tuple(round(v / scale) for v in (fx, fy, fx + fw, fy + fh)) for fx, fy, fw, fh in found]
+
+
+def face_crop(box, w, h, expand=1.8, lift=0.1):
+    """人脸框 → 正方形裁剪 (x0, y0, x1, y1)：边长为框长边的 expand 倍，中心上移 lift 个框高（带上头发），
+    超出原图时平移/收缩到图内"""
+    x0, y0, x1, y1 = box
+    side = min(round(max(x1 - x0, y1 - y0) * expand), w, h)
+    cx, cy = (x0 + x1) / 2, (y0 + y1) / 2 - lift * (y1 - y0)
+    left = int(min(max(round(cx - side / 2), 0), w - side))
+    top = int(min(max(round(cy - side / 2), 0), h - side))
+    return left, top, left + side, top + side
+
+
+def _dedupe(crops):
+    """去掉中心落在更大裁剪里的重复检测"""
+    kept = []
+    for c in sorted(crops, key=lambda c: -(c[2] - c[0])):
+        cx, cy = (c[0] + c[2]) / 2, (c[1] + c[3]) / 2
+        if not any(k[0] <= cx < k[2] and k[1] <= cy < k[3] for k in kept):
+            kept.append(c)
+    return kept
+
+
+def _feather(side, width):
+    """side x side 的贴回权重，四周 width 像素线性过渡到 0"""
+    r = _ramp(side, min(width, side // 2), True, True)
+    return r[:, None] * r[None, :]
+
+
+# ---------- 风格化 ----------
+def stylize_faces(u8, net, device="cpu", upsample_align=False, boxes=None, native=512, bg_net=None,
+                  bg_edge=512, expand=1.8, feather=0.15, fallback_edge=1024, metrics=NULL_METRICS):
+    """3xHxW uint8 → (3xHxW uint8, 实际用的正方形裁剪列表)
+
+    boxes 为人脸框 [(x0, y0, x1, y1)]，None 时自动检测。
+    所有裁剪缩到 native x native 后一批前向，再缩回裁剪大小、按羽化权重贴回底图。
+    底图：bg_net 为 None 时保留原照片；否则用 bg_net（如 paprika）在长边 bg_edge 的低分辨率上跑整图再放大。
+    一张脸也没有时退回整图按 fallback_edge 处理，保证总有输出。
+    """
+    h, w = u8.shape[-2:]
+    if boxes is None:
+        with metrics.timer("detect"):
+            boxes = detect_faces(u8)
+    crops = _dedupe([face_crop(b, w, h, expand) for b in boxes if b[2] > b[0] and b[3] > b[1]])
+    if not crops:
+        logger.info("未找到人脸，整图处理")
+        with metrics.timer("forward"):
+            out = forward_model(net, imageops.preprocess([u8], model_size(w, h, max_edge=fallback_edge)),
+                                device, upsample_align)
+        return imageops.postprocess(out, [(h, w)])[0][0], []
+
+    base = u8
+    if bg_net is not None:
+        with metrics.timer("background"):
+            out = forward_model(bg_net, imageops.preprocess([u8], model_size(w, h, max_edge=bg_edge)),
+                                device, upsample_align)
+            base = imageops.postprocess(out, [(h, w)])[0][0]
+
+    with metrics.timer("resize"):
+        x = imageops.preprocess([u8[:, y0:y1, x0:x1] for x0, y0, x1, y1 in crops], (native, native))
+    with metrics.timer("forward"):
+        faces = imageops.to_u8(forward_model(net, x, device, upsample_align))
+    with metrics.timer("postprocess"):
+        result = base.clone()
+        for (x0, y0, x1, y1), face in zip(crops, faces):
+            side = x1 - x0
+            face = imageops.restore(face, (side, side)).float()
+            m = _feather(side, round(side * feather))
+            region = result[:, y0:y1, x0:x1].float()
+            result[:, y0:y1, x0:x1] = (region + (face - region) * m).round_().to(torch.uint8)
+    return result, crops
+
+
+def infer_faces(image, checkpoint, device="cpu", upsample_align=False, boxes=None, background=None,
+                bg_edge=512, fmt="PNG", metrics=NULL_METRICS):
+    """人脸模式的内存推理，输入输出类型同 anime_infer.infer（PIL / uint8 数组 / bytes）
+
+    background 为底图用的权重路径（如 weights/paprika.pt），None 时保留原照片。
+    """
+    with metrics.timer("load_model"):
+        net = get_model(checkpoint, device)
+        bg_net = get_model(background, device) if background else None
+    out, _ = stylize_faces(_to_u8(image), net, device, upsample_align, boxes, native_size(checkpoint),
+                           bg_net, bg_edge, metrics=metrics)
+    return _like_input(image, out, fmt)
+
+
+def load_boxes(path):
+    """JSON：{"相对输入目录的文件名": [[x0, y0, x1, y1], ...]}"""
+    with open(path, encoding="utf-8") as f:
+        return {k.replace("\\", "/"): [tuple(map(int, b)) for b in v] for k, v in json.load(f).items()}
+
+
+def convert_dir_faces(checkpoint, input_dir, output_dir, device="cpu", upsample_align=False, boxes=None,
+                      background=None, bg_edge=512, recursive=False, metrics=NULL_METRICS):
+    """目录批量人脸模式；boxes 为 load_boxes 的结果，列出的图用给定框，其余自动检测"""
+    net = get_model(checkpoint, device)
+    bg_net = get_model(background, device) if background else None
+    native = native_size(checkpoint)
+    for name in list_images(input_dir, recursive):
+        path = os.path.join(input_dir, name)
+        try:
+            with metrics.timer("load"):
+                u8 = imageops.load(path)
+            out, crops = stylize_faces(u8, net, device, upsample_align, (boxes or {}).get(name.replace("\\", "/")),
+                                       native, bg_net, bg_edge, metrics=metrics)
+            with metrics.timer("save"):
+                imageops.save(out, output_path(path, output_dir, input_dir))
+        except Exception as e:
+            _report_failure(metrics, path, e)
+            continue
+        metrics.inc("processed")
+        metrics.inc("faces", len(crops))
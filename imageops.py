@@ -0,0 +1,144 @@
+# ================ 张量化预处理/后处理：解码进复用缓冲、uint8 上直接缩放、预览从同一输出张量生成 ================
+import io
+import os
+import threading
+import warnings
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+from torchvision.io import ImageReadMode, decode_image, encode_jpeg, encode_png
+
+_local = threading.local()
+
+
+class ReadBuffer:
+    """按需扩容的文件读缓冲；循环里反复复用，不为每个文件新分配 bytes"""
+
+    def __init__(self, size=1 << 20):
+        self.buf = bytearray(size)
+
+    def read(self, path):
+        """返回指向缓冲的一维 uint8 张量，下次 read 之前有效"""
+        n = os.path.getsize(path)
+        if n == 0:
+            raise ValueError(f"{path} 是空文件")
+        if n > len(self.buf):
+            self.buf = bytearray(max(n, 2 * len(self.buf)))
+        with open(path, "rb", buffering=0) as f:
+            got = f.readinto(memoryview(self.buf)[:n])
+        return torch.frombuffer(self.buf, dtype=torch.uint8, count=got)
+
+
+def read_file(path):
+    """用当前线程自己的 ReadBuffer 读文件"""
+    buf = getattr(_local, "buf", None)
+    if buf is None:
+        buf = _local.buf = ReadBuffer()
+    return buf.read(path)
+
+
+def _as_u8(data):
+    if isinstance(data, torch.Tensor):
+        return data
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")           # bytes 只读，decode 也只读它
+        return torch.frombuffer(data, dtype=torch.uint8)
+
+
+def decode(data):
+    """编码后的字节（bytes 或一维 uint8 张量）→ 3xHxW uint8
+
+    jpeg/png/webp/gif 由 torchvision 直接解到张量；bmp/tiff 等解不了的退回 PIL。
+    16 位 PNG 会被解成 uint16，按 65535 → 255 等比缩到 uint8，后面的缩放/归一化都只认 uint8。
+    和 PIL 路径一样不处理 EXIF 方向。
+    """
+    u8 = _as_u8(data)
+    try:
+        x = decode_image(u8, mode=ImageReadMode.RGB)
+        if x.dtype == torch.uint16:
+            x = x.to(torch.int32).add_(128).div_(257, rounding_mode="floor").to(torch.uint8)
+        if x.dtype != torch.uint8:
+            raise RuntimeError(f"不支持的解码类型 {x.dtype}")
+        return x
+    except RuntimeError:
+        img = Image.open(io.BytesIO(u8.numpy().tobytes())).convert("RGB")
+        return torch.from_numpy(np.array(img)).permute(2, 0, 1)
+
+
+def load(path):
+    return decode(read_file(path))
+
+
+def preprocess(images, size):
+    """若干 3xHxW uint8 → Bx3xhxw float [-1,1]，size 为模型输入 (w, h)
+
+    先在 uint8 上做 bicubic 抗锯齿缩放（结果饱和到 0..255，不需要另外 clip），只在模型尺寸上转 float；
+    原图尺寸相同的一批只做一次插值，归一化原地完成。
+    """
+    w, h = size
+    if len({tuple(im.shape) for im in images}) == 1:
+        x = torch.stack(images)
+        if tuple(x.shape[-2:]) != (h, w):
+            x = F.interpolate(x, size=(h, w), mode="bicubic", align_corners=False, antialias=True)
+        return x.float().mul_(2 / 255).sub_(1)
+    return torch.cat([preprocess([im], size) for im in images])
+
+
+def to_u8(out):
+    """模型输出 [-1,1] float → uint8（原地，不保留 out）"""
+    return out.clamp_(-1, 1).add_(1).mul_(127.5).round_().to(torch.uint8)
+
+
+def restore(u8, size):
+    """uint8 输出双线性放大回原图 (h, w)"""
+    if tuple(u8.shape[-2:]) == tuple(size):
+        return u8
+    squeeze = u8.dim() == 3
+    x = u8.unsqueeze(0) if squeeze else u8
+    x = F.interpolate(x, size=size, mode="bilinear", align_corners=False, antialias=True)
+    return x.squeeze(0) if squeeze else x
+
+
+def postprocess(out, sizes):
+    """Bx3xhxw 模型输出 → [3xHxW uint8]，sizes 为各自原图 (h, w)；同时返回模型分辨率的 uint8 批，用来做预览"""
+    small = to_u8(out)
+    return [restore(o, s) for o, s in zip(small, sizes)], small
+
+
+def thumbnail(u8, max_side=512):
+    """3xhxw uint8 → 长边不超过 max_side 的 PIL 预览图，直接从模型分辨率的输出缩，不经过原图尺寸"""
+    h, w = u8.shape[-2:]
+    scale = min(max_side / max(h, w), 1.0)
+    th, tw = max(1, round(h * scale)), max(1, round(w * scale))
+    if (th, tw) != (h, w):
+        u8 = F.interpolate(u8.unsqueeze(0), size=(th, tw), mode="bilinear", align_corners=False,
+                           antialias=True).squeeze(0)
+    return to_pil(u8)
+
+
+def to_pil(u8):
+    return Image.fromarray(u8.permute(1, 2, 0).contiguous().numpy())
+
+
+def _encode(u8, ext, quality):
+    ext = ext.lower()
+    if ext == ".png":
+        return encode_png(u8).numpy()
+    if ext in (".jpg", ".jpeg"):
+        return encode_jpeg(u8, quality=quality).numpy()
+    buf = io.BytesIO()
+    to_pil(u8).save(buf, format=Image.registered_extensions()[ext])
+    return buf.getbuffer()
+
+
+def encode(u8, ext=".png", quality=75):
+    """3xHxW uint8 → 编码字节；png/jpeg 直接由张量编码，其它格式走 PIL（quality 与 PIL 默认一致）"""
+    return bytes(_encode(u8, ext, quality))
+
+
+def save(u8, path, quality=75):
+    data = _encode(u8, os.path.splitext(path)[-1], quality)
+    with open(path, "wb") as f:
+        f.write(data)
@@ -0,0 +1,105 @@
+# ================ 批处理作业：预取解码、暂停/取消、吞吐与剩余时间（与界面无关，GUI 线程里用） ================
+import time
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+
+class JobControl:
+    """暂停/继续/取消开关；工作线程在两张图之间调用 wait()，界面线程随时调用其余方法"""
+
+    def __init__(self):
+        self._running = threading.Event()
+        self._running.set()
+        self._cancelled = threading.Event()
+        self.paused_seconds = 0.0
+
+    def pause(self):
+        self._running.clear()
+
+    def resume(self):
+        self._running.set()
+
+    def cancel(self):
+        self._cancelled.set()
+        self._running.set()          # 暂停中取消也要立刻醒来
+
+    @property
+    def paused(self):
+        return not self._running.is_set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def wait(self):
+        """暂停时阻塞到继续或取消；返回 False 表示已取消，不要再开始下一张"""
+        if not self._running.is_set():
+            t = time.perf_counter()
+            self._running.wait()
+            self.paused_seconds += time.perf_counter() - t
+        return not self._cancelled.is_set()
+
+
+class Progress(NamedTuple):
+    done: int
+    total: int
+    failed: int
+    rate: float          # 张/秒，不含暂停时间
+    eta_s: float         # 剩余秒数，还没完成任何一张时为 -1
+
+
+class Throughput:
+    """按已完成张数和有效耗时（扣掉暂停）算速度和剩余时间"""
+
+    def __init__(self, total, control=None):
+        self.total = total
+        self.control = control
+        self.done = 0
+        self.failed = 0
+        self.start = time.perf_counter()
+
+    def tick(self, ok=True):
+        self.done += 1
+        self.failed += not ok
+        return self.progress()
+
+    def progress(self):
+        paused = self.control.paused_seconds if self.control is not None else 0.0
+        elapsed = max(time.perf_counter() - self.start - paused, 1e-9)
+        rate = self.done / elapsed
+        eta = (self.total - self.done) / rate if self.done else -1.0
+        return Progress(self.done, self.total, self.failed, rate, eta)
+
+
+def format_eta(seconds):
+    if seconds < 0:
+        return "--:--"
+    m, s = divmod(int(round(seconds)), 60)
+    h, m = divmod(m, 60)
+    return f"{h}:{m:02d}:{s:02d}" if h else f"{m:02d}:{s:02d}"
+
+
+def prefetch(items, load, depth=2):
+    """按原顺序 yield (item, load(item) 的结果, 异常)，后台线程始终领先 depth 个
+
+    当前这张在前向时，后面几张的读文件/解码已经在做；调用方中途 break（取消）时未开始的预取直接丢弃。
+    """
+    it = iter(items)
+    pool = ThreadPoolExecutor(1, thread_name_prefix="animegan-prefetch")
+    pending = deque((x, pool.submit(load, x)) for x in itertools.islice(it, depth + 1))
+    try:
+        while pending:
+            item, fut = pending.popleft()
+            for nxt in itertools.islice(it, 1):
+                pending.append((nxt, pool.submit(load, nxt)))
+            try:
+                yield item, fut.result(), None
+            except Exception as e:
+                yield item, None, e
+    finally:
+        for _, fut in pending:
+            fut.cancel()
+        pool.shutdown(wait=True)
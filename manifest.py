@@ -0,0 +1,105 @@
+# ================ 增量同步：output_dir 里的清单记录每张输出的来源 ================
+import os
+import json
+import hashlib
+import tempfile
+
+from result_cache import checkpoint_hash
+
+MANIFEST_NAME = ".animegan_manifest.jsonl"
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class Manifest:
+    """每转完一张就往 jsonl 追加一行，中途被打断也不丢进度；结束时 compact 成每个源一行
+
+    一行记录: {"src", "size", "mtime_ns", "sha256", "model", "settings", "out"}，src/out 为相对路径。
+    model 为权重内容哈希，settings 为所有影响输出的参数；任一变化都视为过期重做。
+    """
+
+    def __init__(self, output_dir, model, settings):
+        self.output_dir = output_dir
+        self.path = os.path.join(output_dir, MANIFEST_NAME)
+        self.model = model
+        self.settings = settings
+        self.entries = {}
+        self._pending = {}
+        self.skipped = self.stale = self.new = 0
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        e = json.loads(line)
+                    except ValueError:
+                        continue          # 上次被打断时最后一行可能只写了一半
+                    self.entries[e["src"]] = e
+
+    def _fresh(self, e):
+        return (e["model"] == self.model and e["settings"] == self.settings
+                and os.path.exists(os.path.join(self.output_dir, e["out"])))
+
+    def plan(self, input_dir, rel_paths):
+        """返回需要(重新)转换的相对路径；未变的跳过，只改了 mtime 而内容相同的顺手更新记录"""
+        todo = []
+        for rel in rel_paths:
+            src = os.path.join(input_dir, rel)
+            st = os.stat(src)
+            e = self.entries.get(rel)
+            if e is not None and self._fresh(e):
+                if e["size"] == st.st_size and e["mtime_ns"] == st.st_mtime_ns:
+                    self.skipped += 1
+                    continue
+                if e["size"] == st.st_size:
+                    sha = file_sha256(src)
+                    if sha == e["sha256"]:
+                        self._append(dict(e, mtime_ns=st.st_mtime_ns))
+                        self.skipped += 1
+                        continue
+            if e is None:
+                self.new += 1
+            else:
+                self.stale += 1
+            self._pending[rel] = (st.st_size, st.st_mtime_ns)
+            todo.append(rel)
+        return todo
+
+    def record(self, rel, out_rel, src_path):
+        size, mtime_ns = self._pending.pop(rel, (None, None))
+        if size is None:
+            st = os.stat(src_path)
+            size, mtime_ns = st.st_size, st.st_mtime_ns
+        self._append({"src": rel, "size": size, "mtime_ns": mtime_ns, "sha256": file_sha256(src_path),
+                      "model": self.model, "settings": self.settings, "out": out_rel})
+
+    def _append(self, e):
+        self.entries[e["src"]] = e
+        os.makedirs(self.output_dir, exist_ok=True)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(e, ensure_ascii=False) + "\n")
+
+    def compact(self, keep=None):
+        """重写清单，每个源只留最后一条；keep 给定时丢掉不在其中的源（源文件已删除）"""
+        entries = [e for src, e in sorted(self.entries.items()) if keep is None or src in keep]
+        fd, tmp = tempfile.mkstemp(dir=self.output_dir, prefix=".manifest-")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            for e in entries:
+                f.write(json.dumps(e, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.path)
+        self.entries = {e["src"]: e for e in entries}
+
+    def summary(self):
+        return {"skipped": self.skipped, "stale": self.stale, "new": self.new}
+
+
+def open_manifest(output_dir, checkpoint, upsample_align=False, variant="fp32", max_edge=1024):
+    """按 anime_infer.convert_dir 的设置打开 output_dir 的清单"""
+    settings = {"max_edge": max_edge, "x32": True, "align": bool(upsample_align), "variant": variant,
+                "resize": "tensor"}
+    return Manifest(output_dir, checkpoint_hash(checkpoint), settings)
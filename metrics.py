@@ -0,0 +1,181 @@
+# ================ 埋点：阶段计时、计数器、可插拔输出 ================
+import os
+import time
+import logging
+import tempfile
+import threading
+import contextlib
+from collections import defaultdict
+
+logger = logging.getLogger("animegan")
+
+_NULL_CTX = contextlib.nullcontext()
+
+
+class NullMetrics:
+    """关闭埋点时用的空实现：所有方法都是空操作，timer 返回同一个 nullcontext，几乎零开销"""
+    enabled = False
+
+    def timer(self, name):
+        return _NULL_CTX
+
+    def observe(self, name, seconds, count=1):
+        pass
+
+    def inc(self, name, n=1):
+        pass
+
+    def event(self, **fields):
+        pass
+
+    def flush(self):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+class Metrics:
+    """线程安全的计数器 + 阶段累计耗时；event 实时转给各 sink，flush 把汇总推给各 sink
+
+    计数器约定：processed / skipped / failed；阶段约定：load_model / load / resize / forward /
+    postprocess / save，以及挂了 block hook 时的 block.<name>。
+    """
+    enabled = True
+
+    def __init__(self, sinks=()):
+        self.sinks = list(sinks)
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(lambda: [0, 0.0])     # name -> [次数, 总秒数]
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t)
+
+    def observe(self, name, seconds, count=1):
+        """记一次（或合并别处汇总好的 count 次）耗时"""
+        with self._lock:
+            rec = self.timings[name]
+            rec[0] += count
+            rec[1] += seconds
+
+    def inc(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def event(self, **fields):
+        for s in self.sinks:
+            s.event(fields)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "timings": {k: {"count": c, "seconds": sec} for k, (c, sec) in self.timings.items()},
+            }
+
+    def flush(self):
+        snap = self.snapshot()
+        for s in self.sinks:
+            s.flush(snap)
+
+
+def attach_block_hooks(net, metrics, names=("block_a", "block_b", "block_c", "block_d", "block_e", "out_layer")):
+    """给 Generator 的各 block 挂计时 hook，记为 block.<name>；返回 handle 列表，用完 remove"""
+    if not metrics.enabled:
+        return []
+    local = threading.local()
+    handles = []
+    for name in names:
+        m = getattr(net, name, None)
+        if m is None:
+            continue
+
+        def pre(mod, inp, name=name):
+            setattr(local, name, time.perf_counter())
+
+        def post(mod, inp, out, name=name):
+            t = getattr(local, name, None)
+            if t is not None:
+                metrics.observe(f"block.{name}", time.perf_counter() - t)
+
+        handles.append(m.register_forward_pre_hook(pre))
+        handles.append(m.register_forward_hook(post))
+    return handles
+
+
+# ---------- sinks ----------
+class LogSink:
+    """结构化日志：一行一个事件，key=value 形式"""
+
+    def __init__(self, log=None, level=logging.INFO):
+        self.log = log or logger
+        self.level = level
+
+    def event(self, fields):
+        self.log.log(self.level, "event " + " ".join(f"{k}={v}" for k, v in fields.items()))
+
+    def flush(self, snap):
+        counters = " ".join(f"{k}={v}" for k, v in sorted(snap["counters"].items()))
+        timings = " ".join(f"{k}={v['seconds']:.3f}s/{v['count']}" for k, v in sorted(snap["timings"].items()))
+        self.log.log(self.level, f"summary {counters} {timings}".rstrip())
+
+
+def render_prometheus(snap, prefix="animegan", gauges=None):
+    """把 Metrics.snapshot() 渲染成 Prometheus 文本格式；gauges 为额外的 {名字: 当前值或 {标签: 值}}"""
+    p = prefix
+    lines = []
+    for k, v in sorted(snap["counters"].items()):
+        lines += [f"# TYPE {p}_{k}_total counter", f"{p}_{k}_total {v}"]
+    lines.append(f"# TYPE {p}_stage_seconds_total counter")
+    for k, v in sorted(snap["timings"].items()):
+        lines.append(f'{p}_stage_seconds_total{{stage="{k}"}} {v["seconds"]:.6f}')
+    lines.append(f"# TYPE {p}_stage_calls_total counter")
+    for k, v in sorted(snap["timings"].items()):
+        lines.append(f'{p}_stage_calls_total{{stage="{k}"}} {v["count"]}')
+    for k, v in sorted((gauges or {}).items()):
+        lines.append(f"# TYPE {p}_{k} gauge")
+        if isinstance(v, dict):          # {'style="paprika"': 3, ...} 带标签的一组值
+            lines += [f"{p}_{k}{{{labels}}} {x}" for labels, x in sorted(v.items())]
+        else:
+            lines.append(f"{p}_{k} {v}")
+    return "\n".join(lines) + "\n"
+
+
+class PrometheusFileSink:
+    """flush 时把汇总写成 Prometheus 文本格式（给 node_exporter 的 textfile collector 读），原子替换"""
+
+    def __init__(self, path, prefix="animegan"):
+        self.path = path
+        self.prefix = prefix
+
+    def event(self, fields):
+        pass
+
+    def flush(self, snap):
+        d = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp = tempfile.mkstemp(dir=d, prefix=".prom-")
+        with os.fdopen(fd, "w") as f:
+            f.write(render_prometheus(snap, self.prefix))
+        os.replace(tmp, self.path)
+
+
+class CallbackSink:
+    """把事件/汇总转给回调，例如 GUI 的 pyqtSignal.emit"""
+
+    def __init__(self, on_event=None, on_flush=None):
+        self.on_event = on_event
+        self.on_flush = on_flush
+
+    def event(self, fields):
+        if self.on_event is not None:
+            self.on_event(fields)
+
+    def flush(self, snap):
+        if self.on_flush is not None:
+            self.on_flush(snap)
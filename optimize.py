@@ -0,0 +1,192 @@
+# ================ 推理专用 Generator：合并 pad/conv/norm/act，导出 TorchScript / ONNX ================
+import copy
+import argparse
+from typing import List
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from model import ConvNormLReLU, InvertedResBlock, Generator
+
+
+class FusedConvNormLReLU(nn.Module):
+    """pad + conv + GroupNorm + LeakyReLU 合成一个模块
+
+    - padding=0 的 ReflectionPad2d（所有 1x1 扩张卷积前都有一个）直接去掉，省一次整张激活的拷贝
+    - 对称的 zero pad 并进 Conv2d 的 padding，由卷积 kernel 内部处理，不再单独拷贝
+    - reflect/replicate pad 合不掉：Conv2d 在 padding_mode 非 zeros 时内部照样先 F.pad 出整张拷贝，
+      所以保留显式 F.pad（3x3/7x7 层的峰值内存和原模型相同）
+    - GroupNorm 的仿射直接走 F.group_norm 的融合 kernel，LeakyReLU 原地执行
+    """
+    pad: List[int]
+
+    def __init__(self, block: ConvNormLReLU):
+        super().__init__()
+        pad, conv, norm, act = block
+        conv = copy.deepcopy(conv)
+        p = tuple(pad.padding)            # (left, right, top, bottom)
+        mode = {nn.ReflectionPad2d: "reflect", nn.ReplicationPad2d: "replicate",
+                nn.ZeroPad2d: "zeros"}[type(pad)]
+        self.pad = []
+        self.pad_mode = "constant" if mode == "zeros" else mode
+        if any(p):
+            if mode == "zeros" and p[0] == p[1] == p[2] == p[3]:
+                conv.padding = (p[0], p[0])
+            else:
+                self.pad = list(p)
+        self.conv = conv
+        self.num_groups = norm.num_groups
+        self.eps = norm.eps
+        self.weight = norm.weight
+        self.bias = norm.bias
+        self.slope = act.negative_slope
+
+    def forward(self, x):
+        if len(self.pad) > 0:
+            x = F.pad(x, self.pad, mode=self.pad_mode)
+        x = self.conv(x)
+        x = F.group_norm(x, self.num_groups, self.weight, self.bias, self.eps)
+        return F.leaky_relu_(x, self.slope)
+
+
+class FusedInvertedResBlock(nn.Module):
+    def __init__(self, block: InvertedResBlock):
+        super().__init__()
+        self.use_res_connect = block.use_res_connect
+        self.layers = _fuse(copy.deepcopy(block.layers))
+
+    def forward(self, input):
+        out = self.layers(input)
+        if self.use_res_connect:
+            out += input          # out 是新分配的，残差原地加
+        return out
+
+
+def _fuse(module):
+    if isinstance(module, ConvNormLReLU):
+        return FusedConvNormLReLU(module)
+    if isinstance(module, InvertedResBlock):
+        return FusedInvertedResBlock(module)
+    for name, child in module.named_children():
+        setattr(module, name, _fuse(child))
+    return module
+
+
+class FusedGenerator(nn.Module):
+    """与 Generator 同结构同权重，forward 带类型注解以便 torch.jit.script"""
+
+    def __init__(self, generator: Generator):
+        super().__init__()
+        for name in ("block_a", "block_b", "block_c", "block_d", "block_e", "out_layer"):
+            setattr(self, name, _fuse(copy.deepcopy(getattr(generator, name))))
+
+    def forward(self, input, align_corners: bool = True):
+        out = self.block_a(input)
+        half_size = out.shape[-2:]
+        out = self.block_b(out)
+        out = self.block_c(out)
+
+        if align_corners:
+            out = F.interpolate(out, size=half_size, mode="bilinear", align_corners=True)
+        else:
+            out = F.interpolate(out, scale_factor=2.0, mode="bilinear", align_corners=False)
+        out = self.block_d(out)
+
+        if align_corners:
+            out = F.interpolate(out, size=input.shape[-2:], mode="bilinear", align_corners=True)
+        else:
+            out = F.interpolate(out, scale_factor=2.0, mode="bilinear", align_corners=False)
+        out = self.block_e(out)
+
+        return self.out_layer(out)
+
+
+def optimize_for_inference(generator: Generator):
+    """返回融合后的 FusedGenerator（权重数值相同，eval 模式），原模型不变
+
+    GroupNorm(num_groups=1) 之后紧跟 LeakyReLU 或残差相加，中间没有可吸收仿射的线性层，
+    所以仿射不做权重折叠，而是交给 F.group_norm 一次算完。
+    """
+    net = FusedGenerator(generator).eval()
+    for p in net.parameters():
+        p.requires_grad_(False)
+    return net
+
+
+class _AlignedGenerator(nn.Module):
+    """把 align_corners 固定下来，方便 trace / ONNX 导出（它们只认张量输入）"""
+
+    def __init__(self, net, align_corners):
+        super().__init__()
+        self.net = net
+        self.align_corners = align_corners
+
+    def forward(self, x):
+        return self.net(x, self.align_corners)
+
+
+def script_for_inference(generator):
+    """融合 + torch.jit.script + freeze，返回可 torch.jit.save 的模块，调用方式同 Generator"""
+    return torch.jit.freeze(torch.jit.script(optimize_for_inference(generator)))
+
+
+def compile_for_inference(generator, align_corners=False, **kwargs):
+    """融合 + torch.compile，kwargs 透传给 torch.compile"""
+    net = _AlignedGenerator(optimize_for_inference(generator), align_corners).eval()
+    return torch.compile(net, **kwargs)
+
+
+def export_onnx(generator, path, size=(512, 512), align_corners=False, opset=17):
+    """导出 ONNX（需要 onnx / onnxscript 包），H/W 为动态维度；输入输出都是 BCHW [-1,1]"""
+    net = _AlignedGenerator(optimize_for_inference(generator), align_corners).eval()
+    x = torch.zeros(1, 3, *size)
+    with torch.no_grad():
+        torch.onnx.export(net, (x,), path, input_names=["input"], output_names=["output"],
+                          opset_version=opset,
+                          dynamic_axes={"input": {0: "batch", 2: "height", 3: "width"},
+                                        "output": {0: "batch", 2: "height", 3: "width"}})
+    return path
+
+
+def check_equivalence(eager, optimized, sizes=((256, 256), (320, 448)), batch=1, atol=1e-5, seed=0):
+    """在随机输入上比较 eager 与优化后模型，两条 align_corners 路径都测
+
+    optimized 可以是 Generator 风格（forward(x, align_corners)），也可以是固定了 align 的
+    单输入模块（_AlignedGenerator / compile_for_inference 的结果）。返回最大误差，超过 atol 抛 AssertionError。
+    """
+    g = torch.Generator().manual_seed(seed)
+    worst = 0.0
+    fixed = getattr(optimized, "align_corners", None)
+    aligns = (True, False) if fixed is None else (bool(fixed),)
+    with torch.no_grad():
+        for h, w in sizes:
+            x = torch.rand(batch, 3, h, w, generator=g) * 2 - 1
+            for align in aligns:
+                ref = eager(x, align)
+                out = optimized(x) if fixed is not None else optimized(x, align)
+                worst = max(worst, (ref - out).abs().max().item())
+    if worst > atol:
+        raise AssertionError(f"优化模型与 eager 结果不一致: max|diff|={worst:.3g} > {atol}")
+    return worst
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, default='./weights/paprika.pt')
+    parser.add_argument('--upsample_align', action='store_true')
+    parser.add_argument('--torchscript', type=str, default=None, help='保存 TorchScript 的路径')
+    parser.add_argument('--onnx', type=str, default=None, help='保存 ONNX 的路径')
+    args = parser.parse_args()
+
+    eager = Generator()
+    eager.load_state_dict(torch.load(args.checkpoint, map_location="cpu"))
+    eager.eval()
+    print(f"fused max|diff| = {check_equivalence(eager, optimize_for_inference(eager)):.3g}")
+    if args.torchscript:
+        ts = script_for_inference(eager)
+        print(f"torchscript max|diff| = {check_equivalence(eager, ts):.3g}")
+        torch.jit.save(ts, args.torchscript)
+    if args.onnx:
+        export_onnx(eager, args.onnx, align_corners=args.upsample_align)
+        print(f"onnx saved to {args.onnx}")
@@ -0,0 +1,201 @@
+# ================ 流水线：解码 / 推理 / 编码 三段并行 ================
+import os
+import time
+import queue
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import torch
+
+import imageops
+from metrics import NULL_METRICS
+from anime_infer import get_model, list_images, model_size, plan_batches, output_path, forward_model
+
+Result = namedtuple("Result", ["path", "out_path", "image", "error"])
+
+_DONE = object()
+
+
+class PipelineStats:
+    """各阶段累计耗时/数量，线程安全
+
+    busy 为该阶段所有 worker 实际干活的总秒数；model 阶段的 wait 为等解码喂数据的秒数，
+    wait 占比高说明解码跟不上，应加 decode_workers。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stages = {name: {"count": 0, "busy": 0.0, "wait": 0.0}
+                       for name in ("decode", "model", "encode")}
+        self.failed = 0
+        self.wall = 0.0
+
+    def add(self, stage, count=0, busy=0.0, wait=0.0):
+        with self._lock:
+            st = self.stages[stage]
+            st["count"] += count
+            st["busy"] += busy
+            st["wait"] += wait
+
+    def summary(self):
+        with self._lock:
+            out = {k: dict(v) for k, v in self.stages.items()}
+            out["failed"] = self.failed
+            out["wall"] = self.wall
+            n = self.stages["encode"]["count"]
+            out["images_per_sec"] = n / self.wall if self.wall else 0.0
+            return out
+
+    def __str__(self):
+        s = self.summary()
+        parts = [f"{k}: n={s[k]['count']} busy={s[k]['busy']:.2f}s wait={s[k]['wait']:.2f}s"
+                 for k in ("decode", "model", "encode")]
+        return " | ".join(parts) + f" | failed={s['failed']} wall={s['wall']:.2f}s ({s['images_per_sec']:.2f} img/s)"
+
+
+def _decode(paths, max_edge, stats, metrics):
+    t = time.perf_counter()
+    items = []
+    for path in paths:
+        try:
+            with metrics.timer("load"):
+                img = imageops.load(path)
+            h, w = img.shape[-2:]
+            with metrics.timer("resize"):
+                x = imageops.preprocess([img], model_size(w, h, max_edge=max_edge))
+            items.append((path, x, (h, w), None))
+        except Exception as e:
+            items.append((path, None, None, e))
+    stats.add("decode", count=len(paths), busy=time.perf_counter() - t)
+    return items
+
+
+def _forward_isolated(net, items, device, upsample_align):
+    """同 anime_infer._convert_isolated：整批前向失败（如某一批 OOM）时逐张重试；返回 [(item, 输出或 None, 异常或 None)]"""
+    try:
+        out = forward_model(net, torch.cat([it[1] for it in items]), device, upsample_align)
+        return [(it, o, None) for it, o in zip(items, out)]
+    except Exception as e:
+        if len(items) == 1:
+            return [(items[0], None, e)]
+    return [r for it in items for r in _forward_isolated(net, [it], device, upsample_align)]
+
+
+def _encode(path, out, size, output_dir, input_root, stats, metrics):
+    t = time.perf_counter()
+    try:
+        with metrics.timer("postprocess"):
+            (img,), _ = imageops.postprocess(out.unsqueeze(0), [size])
+        if output_dir is None:
+            return Result(path, None, imageops.to_pil(img), None)
+        out_path = output_path(path, output_dir, input_root)
+        with metrics.timer("save"):
+            imageops.save(img, out_path)
+        return Result(path, out_path, None, None)
+    except Exception as e:
+        return Result(path, None, None, e)
+    finally:
+        stats.add("encode", count=1, busy=time.perf_counter() - t)
+
+
+def iter_convert(net, paths, output_dir=None, device="cpu", upsample_align=False,
+                 decode_workers=2, encode_workers=2, prefetch=4,
+                 batch_size=1, max_batch_pixels=2 * 1024 * 1024, max_edge=1024, stats=None,
+                 input_root=None, metrics=NULL_METRICS):
+    """流式转换，按完成顺序逐个 yield Result(path, out_path, image, error)
+
+    解码线程池提前解码 + 缩放最多 prefetch 批放进有界队列，推理在调用方线程里消费，
+    结果交给编码线程池做缩放回原尺寸 + 保存。output_dir 为 None 时只返回 PIL 图不落盘（落盘时 image 为 None）；
+    给了 input_root 时输出保持相对 input_root 的目录结构。
+    metrics 记录 load / resize / forward / postprocess / save 各阶段耗时（计数由调用方按结果记）。
+    """
+    stats = stats if stats is not None else PipelineStats()
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    t_start = time.perf_counter()
+    batches = plan_batches(paths, batch_size, max_batch_pixels, max_edge=max_edge)
+    decoded = queue.Queue(maxsize=max(1, prefetch))
+    stop = threading.Event()
+
+    dec_pool = ThreadPoolExecutor(max(1, decode_workers), thread_name_prefix="decode")
+    enc_pool = ThreadPoolExecutor(max(1, encode_workers), thread_name_prefix="encode")
+
+    def producer():
+        # 有界队列里放 future，队列满时阻塞，内存里最多 prefetch + decode_workers 批
+        for batch in batches:
+            if stop.is_set():
+                break
+            decoded.put(dec_pool.submit(_decode, batch, max_edge, stats, metrics))
+        decoded.put(_DONE)
+
+    feeder = threading.Thread(target=producer, daemon=True)
+    feeder.start()
+    pending = set()
+    try:
+        while True:
+            t = time.perf_counter()
+            fut = decoded.get()
+            if fut is _DONE:
+                break
+            items = fut.result()
+            t_model = time.perf_counter()
+            stats.add("model", wait=t_model - t)
+
+            good = [it for it in items if it[3] is None]
+            for path, _, _, err in items:
+                if err is not None:
+                    stats.failed += 1
+                    yield Result(path, None, None, err)
+            if good:
+                with metrics.timer("forward"):
+                    results = _forward_isolated(net, good, device, upsample_align)
+                stats.add("model", count=len(good), busy=time.perf_counter() - t_model)
+                for (path, _, size, _), o, err in results:
+                    if err is not None:
+                        stats.failed += 1
+                        yield Result(path, None, None, err)
+                    else:
+                        pending.add(enc_pool.submit(_encode, path, o, size, output_dir, input_root, stats, metrics))
+
+            # 先把已完成的吐出去；积压太多时阻塞等编码，保证内存有界
+            block = len(pending) > max(1, encode_workers) * 2
+            done, pending = wait(pending, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+            for f in done:
+                yield _count_failure(f.result(), stats)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in done:
+                yield _count_failure(f.result(), stats)
+    finally:
+        stop.set()
+        # 生成器被提前关闭时，解开可能阻塞在 put 上的 producer
+        while feeder.is_alive():
+            try:
+                decoded.get_nowait()
+            except queue.Empty:
+                feeder.join(0.01)
+        dec_pool.shutdown(wait=True, cancel_futures=True)
+        enc_pool.shutdown(wait=True, cancel_futures=True)
+        stats.wall = time.perf_counter() - t_start
+
+
+def _count_failure(result, stats):
+    if result.error is not None:
+        stats.failed += 1
+    return result
+
+
+def run_pipeline(checkpoint, input_dir, output_dir, device="cpu", upsample_align=False,
+                 decode_workers=2, encode_workers=2, prefetch=4,
+                 batch_size=1, max_batch_pixels=2 * 1024 * 1024):
+    """整目录流水线转换，返回 PipelineStats"""
+    net = get_model(checkpoint, device)
+    paths = [os.path.join(input_dir, n) for n in list_images(input_dir)]
+    stats = PipelineStats()
+    for _ in iter_convert(net, paths, output_dir, device, upsample_align,
+                          decode_workers=decode_workers, encode_workers=encode_workers,
+                          prefetch=prefetch, batch_size=batch_size,
+                          max_batch_pixels=max_batch_pixels, stats=stats):
+        pass
+    return stats
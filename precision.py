@@ -0,0 +1,187 @@
+# ================ 低精度 CPU 推理：bf16 autocast / int8 量化 + 画质评估 ================
+import os
+import io
+import copy
+import time
+import argparse
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+import torch.ao.quantization as tq
+import torch.ao.nn.quantized.dynamic as nnqd
+from torchvision.transforms.functional import to_tensor
+
+from anime_infer import get_model, list_images, load_image, forward
+
+PRECISIONS = ("fp32", "bf16", "int8", "int8-dynamic")
+
+
+def bf16_supported():
+    """CPU 是否有原生 bf16 指令（AVX512_BF16 / AMX），没有的话 bf16 只会更慢"""
+    try:
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except Exception:
+        return False
+
+
+class AutocastGenerator(nn.Module):
+    """权重保持 fp32，前向在 CPU autocast 下跑；调用方式同 Generator"""
+
+    def __init__(self, net, dtype=torch.bfloat16):
+        super().__init__()
+        self.net = net
+        self.dtype = dtype
+
+    def forward(self, input, align_corners=True):
+        with torch.autocast("cpu", dtype=self.dtype):
+            return self.net(input, align_corners).float()
+
+
+class _QuantConv(nn.Module):
+    """QuantStub → Conv2d → DeQuantStub，只量化这一层，前后仍是 fp32"""
+
+    def __init__(self, conv):
+        super().__init__()
+        self.quant = tq.QuantStub()
+        self.conv = conv
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def _quant_targets(net):
+    """1x1 逐点卷积和普通 (groups=1) 卷积；depthwise 卷积计算量小、量化误差大，保持 fp32"""
+    return [(name, m) for name, m in net.named_modules()
+            if isinstance(m, nn.Conv2d) and m.groups == 1]
+
+
+def _replace(net, name, new):
+    parent, _, attr = name.rpartition(".")
+    setattr(net.get_submodule(parent) if parent else net, attr, new)
+
+
+def quantize_int8(net, calib=None, dynamic=False, engine="x86"):
+    """返回 int8 量化后的副本
+
+    static:  每个目标卷积前后插 Quant/DeQuant，用 calib（BCHW [0,1] 张量的可迭代对象）
+             跑一遍统计激活范围，再转换成 quantized.Conv2d
+    dynamic: 只离线量化权重，激活的 scale 每次前向现算，不需要校准数据
+    """
+    torch.backends.quantized.engine = engine
+    qnet = copy.deepcopy(net).cpu().float().eval()
+    targets = _quant_targets(qnet)
+    if dynamic:
+        names = {name for name, _ in targets}
+        return tq.quantize_dynamic(qnet, qconfig_spec={n: tq.default_dynamic_qconfig for n in names},
+                                   mapping={nn.Conv2d: nnqd.Conv2d})
+    if calib is None:
+        raise ValueError("静态量化需要校准图片")
+    qconfig = tq.get_default_qconfig(engine)
+    for name, conv in targets:
+        wrapper = _QuantConv(conv)
+        wrapper.qconfig = qconfig
+        _replace(qnet, name, wrapper)
+    tq.prepare(qnet, inplace=True)
+    with torch.no_grad():
+        for x in calib:
+            qnet(x * 2 - 1, False)
+    tq.convert(qnet, inplace=True)
+    return qnet
+
+
+def calibration_batches(image_dir, limit=16, max_edge=512):
+    """从目录里取最多 limit 张图做校准，缩到 max_edge 以内，逐张 yield 1x3xHxW [0,1]"""
+    for name in list_images(image_dir)[:limit]:
+        img, _ = load_image(os.path.join(image_dir, name), max_edge=max_edge, x32=True)
+        yield to_tensor(img).unsqueeze(0)
+
+
+def prepare_precision(net, precision="fp32", calib_dir=None):
+    """按精度模式包装/转换模型；返回的模块调用方式同 Generator，只能跑在 CPU 上（fp32 除外）"""
+    if precision == "fp32":
+        return net
+    if precision == "bf16":
+        return AutocastGenerator(net)
+    if precision == "int8":
+        if calib_dir is None:
+            raise ValueError("int8 静态量化需要 --calib_dir")
+        return quantize_int8(net, calibration_batches(calib_dir))
+    if precision == "int8-dynamic":
+        return quantize_int8(net, dynamic=True)
+    raise ValueError(f"未知精度模式: {precision}，可选 {PRECISIONS}")
+
+
+# ---------- 画质指标：输入均为 BCHW [0,1] ----------
+def psnr(a, b):
+    mse = F.mse_loss(a.float(), b.float()).item()
+    return float("inf") if mse == 0 else 10 * torch.log10(torch.tensor(1.0 / mse)).item()
+
+
+def ssim(a, b, window=11, sigma=1.5):
+    """逐通道高斯窗 SSIM，取全图平均"""
+    a, b = a.float(), b.float()
+    c = a.size(1)
+    coords = torch.arange(window, dtype=torch.float32) - window // 2
+    g = torch.exp(-coords ** 2 / (2 * sigma ** 2))
+    g = g / g.sum()
+    kernel = (g[:, None] * g[None, :]).expand(c, 1, window, window).contiguous()
+    blur = lambda x: F.conv2d(x, kernel, groups=c)
+    mu_a, mu_b = blur(a), blur(b)
+    var_a = blur(a * a) - mu_a ** 2
+    var_b = blur(b * b) - mu_b ** 2
+    cov = blur(a * b) - mu_a * mu_b
+    c1, c2 = 0.01 ** 2, 0.03 ** 2
+    s = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / ((mu_a ** 2 + mu_b ** 2 + c1) * (var_a + var_b + c2))
+    return s.mean().item()
+
+
+def model_bytes(net):
+    """序列化后的 state_dict 大小"""
+    buf = io.BytesIO()
+    torch.save(net.state_dict(), buf)
+    return buf.tell()
+
+
+def evaluate(net, images, precisions=PRECISIONS, calib_dir=None, upsample_align=False):
+    """以 fp32 输出为参考，给每种精度算平均 PSNR/SSIM、单张耗时和权重大小
+
+    images 为 BCHW [0,1] 张量列表。返回 {precision: {...}}。
+    """
+    refs = [forward(net, x, upsample_align=upsample_align) for x in images]
+    report = {}
+    for p in precisions:
+        if p == "bf16" and not bf16_supported():
+            report[p] = {"skipped": "CPU 不支持原生 bf16"}
+            continue
+        m = prepare_precision(net, p, calib_dir)
+        t = time.perf_counter()
+        outs = [forward(m, x, upsample_align=upsample_align) for x in images]
+        sec = (time.perf_counter() - t) / max(len(images), 1)
+        report[p] = {
+            "psnr": sum(psnr(o, r) for o, r in zip(outs, refs)) / len(refs),
+            "ssim": sum(ssim(o, r) for o, r in zip(outs, refs)) / len(refs),
+            "sec_per_image": sec,
+            "model_bytes": model_bytes(m),
+        }
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, default='./weights/paprika.pt')
+    parser.add_argument('--calib_dir', type=str, required=True, help='int8 静态量化的校准图片目录')
+    parser.add_argument('--eval_dir', type=str, default=None, help='评估图片目录，默认同 calib_dir')
+    parser.add_argument('--precisions', nargs='+', default=list(PRECISIONS), choices=PRECISIONS)
+    parser.add_argument('--upsample_align', action='store_true')
+    args = parser.parse_args()
+
+    net = get_model(args.checkpoint, "cpu")
+    images = list(calibration_batches(args.eval_dir or args.calib_dir, limit=8, max_edge=1024))
+    for p, r in evaluate(net, images, args.precisions, args.calib_dir, args.upsample_align).items():
+        if "skipped" in r:
+            print(f"{p:>13}: 跳过（{r['skipped']}）")
+        else:
+            print(f"{p:>13}: PSNR={r['psnr']:.2f}dB SSIM={r['ssim']:.4f} "
+                  f"{r['sec_per_image'] * 1000:.0f}ms/img weights={r['model_bytes'] / 1e6:.2f}MB")
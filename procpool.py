@@ -0,0 +1,165 @@
+# ================ 多进程 CPU 推理：K 个 worker 各占 cores/K 个线程，权重走共享内存 ================
+import os
+import time
+import queue
+import argparse
+
+import torch
+import torch.multiprocessing as mp
+
+from anime_infer import get_model, plan_batches, output_path, _convert_isolated
+import imageops
+from metrics import NULL_METRICS, Metrics
+from pipeline import Result
+
+
+def cpu_cores():
+    """本进程可用的核数（考虑 taskset / cgroup 亲和性）"""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def _set_threads(threads):
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass          # 已经跑过并行算子后不能再改，不影响 intra-op 设置
+
+
+def _worker(net, tasks, results, threads, device, upsample_align, max_edge, output_dir, input_root, timed):
+    _set_threads(threads)
+    while True:
+        batch = tasks.get()
+        if batch is None:
+            break
+        # 各阶段耗时在子进程里记进本批自己的 Metrics，随结果一起发回主进程合并
+        metrics = Metrics() if timed else NULL_METRICS
+        done = []
+        for path, out, err in _convert_isolated(net, batch, device, upsample_align, metrics, max_edge):
+            out_path = None
+            if err is None:
+                try:
+                    out_path = output_path(path, output_dir, input_root)
+                    with metrics.timer("save"):
+                        imageops.save(out, out_path)
+                except Exception as e:
+                    err = e
+            # 异常对象不一定能 pickle，只传文本
+            done.append((path, out_path if err is None else None,
+                         None if err is None else f"{type(err).__name__}: {err}"))
+        # 耗时先于本批结果发出，主进程收齐所有图时各批耗时都已到
+        if timed:
+            results.put((None, metrics.snapshot()["timings"], None))
+        for r in done:
+            results.put(r)
+
+
+def _check_shareable(net):
+    """量化模型（torch.ao 的 packed 权重）不能 share_memory，也不能随 spawn 传给子进程"""
+    if any(type(m).__module__.startswith(("torch.ao.nn.quantized", "torch.nn.quantized"))
+           for m in net.modules()):
+        raise ValueError("int8 量化模型不支持多进程推理，请用单进程或 bf16")
+
+
+def iter_convert_processes(net, paths, output_dir, device="cpu", upsample_align=False, processes=2,
+                           threads=None, batch_size=1, max_batch_pixels=2 * 1024 * 1024, max_edge=1024,
+                           input_root=None, start_method="spawn", metrics=NULL_METRICS):
+    """多进程转换，按完成顺序 yield pipeline.Result(path, out_path, None, error)
+
+    所有批先放进一个共享任务队列，worker 空闲就取下一批（谁快谁多拿，不会有进程早早闲着）。
+    net.share_memory() 后传给子进程的只是共享内存句柄，K 个进程共用一份权重。
+    worker 进程意外退出时，没拿到结果的图记为失败。
+    metrics 开着时子进程记下的 load / resize / forward / postprocess / save 耗时按批合并进来。
+    """
+    _check_shareable(net)
+    ctx = mp.get_context(start_method)
+    threads = threads or max(1, cpu_cores() // processes)
+    net.share_memory()
+    batches = plan_batches(paths, batch_size, max_batch_pixels, max_edge=max_edge)
+    tasks, results = ctx.Queue(), ctx.Queue()
+    for b in batches:
+        tasks.put(b)
+    for _ in range(processes):
+        tasks.put(None)
+    procs = [ctx.Process(target=_worker, daemon=True,
+                         args=(net, tasks, results, threads, device, upsample_align, max_edge,
+                               output_dir, input_root, metrics.enabled))
+             for _ in range(min(processes, max(len(batches), 1)))]
+    for p in procs:
+        p.start()
+    pending = set(paths)
+    try:
+        while pending:
+            try:
+                path, out_path, err = results.get(timeout=0.5)
+            except queue.Empty:
+                if not any(p.is_alive() for p in procs):
+                    break
+                continue
+            if path is None:
+                for name, t in out_path.items():
+                    metrics.observe(name, t["seconds"], t["count"])
+                continue
+            pending.discard(path)
+            yield Result(path, out_path, None, None if err is None else RuntimeError(err))
+        codes = [p.exitcode for p in procs]
+        for path in sorted(pending):
+            yield Result(path, None, None, RuntimeError(f"worker 进程异常退出 (exitcode={codes})"))
+    finally:
+        for p in procs:
+            p.join(timeout=5)
+            if p.is_alive():
+                p.terminate()
+                p.join()
+
+
+# ---------- 自动选 K ----------
+def _bench_worker(net, threads, size, repeats, start, results):
+    _set_threads(threads)
+    x = torch.rand(1, 3, size, size) * 2 - 1
+    with torch.no_grad():
+        net(x, False)              # 预热
+        start.wait()
+        t = time.perf_counter()
+        for _ in range(repeats):
+            net(x, False)
+    results.put(time.perf_counter() - t)
+
+
+def autotune_processes(net, cores=None, size=256, repeats=3, candidates=None, start_method="spawn"):
+    """K 个进程同时跑 forward，取总吞吐最高的 K；返回 (K, {K: 张/秒})"""
+    _check_shareable(net)
+    ctx = mp.get_context(start_method)
+    cores = cores or cpu_cores()
+    if candidates is None:
+        candidates = sorted({k for k in (1, 2, 4, 8, 16, 32, 64, cores) if k <= cores})
+    net.share_memory()
+    scores = {}
+    for k in candidates:
+        start, results = ctx.Event(), ctx.Queue()
+        procs = [ctx.Process(target=_bench_worker, daemon=True,
+                             args=(net, max(1, cores // k), size, repeats, start, results))
+                 for _ in range(k)]
+        for p in procs:
+            p.start()
+        start.set()
+        times = [results.get() for _ in procs]
+        for p in procs:
+            p.join()
+        scores[k] = k * repeats / max(times)
+    return max(scores, key=scores.get), scores
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, default='./weights/paprika.pt')
+    parser.add_argument('--size', type=int, default=256, help='测速用的输入边长')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args()
+    best, scores = autotune_processes(get_model(args.checkpoint), size=args.size, repeats=args.repeats)
+    for k, v in scores.items():
+        print(f"processes={k} threads={max(1, cpu_cores() // k)}: {v:.2f} img/s")
+    print("best:", best)
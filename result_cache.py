@@ -0,0 +1,175 @@
+# ================ 结果缓存：内容寻址、跨进程共享、落盘持久化 ================
+import os
+import hashlib
+import pathlib
+import tempfile
+import threading
+
+CACHE_DIR = pathlib.Path(os.environ.get("ANIMEGAN_CACHE_DIR", pathlib.Path(__file__).parent / "cache"))
+
+_ckpt_hashes = {}
+_ckpt_lock = threading.Lock()
+
+
+def checkpoint_hash(checkpoint):
+    """权重文件内容的 sha256；按 (路径, mtime, 大小) 记忆，同一文件只读一次"""
+    path = os.path.abspath(checkpoint)
+    st = os.stat(path)
+    memo = (path, st.st_mtime_ns, st.st_size)
+    with _ckpt_lock:
+        if memo in _ckpt_hashes:
+            return _ckpt_hashes[memo]
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    with _ckpt_lock:
+        _ckpt_hashes[memo] = h.hexdigest()
+    return _ckpt_hashes[memo]
+
+
+class ResultCache:
+    """按 sha256 分两级目录存编码后的输出（root/ab/cd/<key>），多进程可同时读写
+
+    - 写入先落临时文件再 os.replace，读者不会看到半截文件
+    - 命中时刷新 mtime，总大小超过 max_bytes 时按 mtime 从旧到新淘汰到 90%
+    - 总大小是本进程的估计值，淘汰时重新扫描目录校正
+    """
+
+    def __init__(self, root=CACHE_DIR, max_bytes=2 * 1024 ** 3):
+        self.root = pathlib.Path(root)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.puts = self.evictions = 0
+        self._total = None
+
+    @staticmethod
+    def make_key(data, checkpoint, policy, align):
+        """(输入字节, 权重内容, 缩放策略, align_corners) → 十六进制 key
+
+        policy 是描述预处理和输出格式的字符串，由 make_policy 生成，任何会改变输出的设置都要写进去。
+        """
+        h = hashlib.sha256()
+        h.update(hashlib.sha256(data).digest())
+        h.update(checkpoint_hash(checkpoint).encode())
+        h.update(f"|{policy}|align={bool(align)}".encode())
+        return h.hexdigest()
+
+    def _path(self, key):
+        return self.root / key[:2] / key[2:4] / key
+
+    def get(self, key):
+        p = self._path(key)
+        try:
+            data = p.read_bytes()
+        except OSError:
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            os.utime(p)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, key, data):
+        p = self._path(key)
+        p.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=p.parent, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, p)
+        except BaseException:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            raise
+        with self._lock:
+            self.puts += 1
+            if self._total is None:
+                self._total = self._scan_total()      # 已包含刚写入的这条
+            else:
+                self._total += len(data)
+            over = self._total > self.max_bytes
+        if over:
+            self.evict()
+
+    def _entries(self):
+        if not self.root.exists():
+            return []
+        out = []
+        for dirpath, _, files in os.walk(self.root):
+            for name in files:
+                if name.startswith(".tmp-"):
+                    continue
+                try:
+                    st = os.stat(os.path.join(dirpath, name))
+                except OSError:
+                    continue
+                out.append((st.st_mtime, st.st_size, os.path.join(dirpath, name)))
+        return out
+
+    def _scan_total(self):
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self, target=None):
+        """删最久未用的条目直到总大小 ≤ target（默认 max_bytes 的 90%）"""
+        target = self.max_bytes * 0.9 if target is None else target
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, path in entries:
+            if total <= target:
+                break
+            try:
+                os.unlink(path)
+                total -= size
+                removed += 1
+            except OSError:
+                pass
+        with self._lock:
+            self._total = total
+            self.evictions += removed
+        return removed
+
+    def clear(self):
+        return self.evict(target=0)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "puts": self.puts,
+                "evictions": self.evictions,
+                "bytes": self._total if self._total is not None else self._scan_total(),
+            }
+
+
+def make_policy(max_edge=1024, variant="fp32", fmt="png", full_size=True):
+    """make_key 用的缩放策略字符串；命令行 / GUI / 网页都用它拼，同样的设置才能互相命中
+
+    variant 为推理精度（fp32 / bf16 / int8 ...），fmt 为输出编码（"png" 或 ".jpg" 均可），
+    full_size=False 表示输出停在处理分辨率、没有放大回原图尺寸（网页端先压缩再推理）。
+    """
+    fmt = fmt.lower().lstrip(".")
+    return f"max{max_edge}/x32/tensor/{variant}/{fmt}" + ("" if full_size else "/small")
+
+
+_default = None
+_default_lock = threading.Lock()
+
+
+def get_cache():
+    """进程内共享的默认缓存（目录可用环境变量 ANIMEGAN_CACHE_DIR 覆盖）"""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = ResultCache()
+        return _default
@@ -0,0 +1,124 @@
+# ================ 自适应分辨率：按目标延迟和当前负载给每个请求挑处理分辨率 ================
+import math
+import threading
+import time
+from contextlib import contextmanager
+from typing import NamedTuple, Optional
+
+import torch
+
+from anime_infer import forward_model, model_size
+from metrics import logger
+
+
+class Plan(NamedTuple):
+    max_edge: int                 # 传给 infer(max_edge=...) 的长边上限
+    size: tuple                   # 模型实际输入 (w, h)
+    expected_s: Optional[float]   # 预计处理耗时（不含排队）；还没测过单价时为 None
+    load: int                     # 做决定时在途的请求数
+    degraded: bool                # 是否为了赶目标延迟降了分辨率
+
+    def __str__(self):
+        return f"{self.size[0]}x{self.size[1]}"
+
+
+class ResolutionScheduler:
+    """目标延迟 → 每个请求的处理分辨率
+
+    单价模型：处理耗时 ≈ overhead_s + sec_per_mp × 模型输入百万像素。
+    启动时 calibrate 在两个尺寸上实测前向拟合，之后用真实耗时（含前后处理）做指数平均；
+    只采独占时的耗时，并发时互相抢核拖慢的耗时不算，否则负载一退单价仍虚高、迟迟回不到满分辨率。
+    前面还有 load 个请求时它们共用同一批核，本请求只分到 target_s / (load + 1) 的预算，
+    按预算反推能处理的像素数，再换算成长边（按 step 向下取整，夹在 [min_edge, max_edge]）。
+    空闲时预算足够就回到 max_edge；target_s=None 或还没有单价时一律 max_edge。
+    """
+
+    def __init__(self, target_s=3.0, max_edge=1024, min_edge=256, step=32, sec_per_mp=None, overhead_s=0.0,
+                 alpha=0.3):
+        self.target_s = target_s
+        self.max_edge = max_edge
+        self.min_edge = min(min_edge, max_edge)
+        self.step = step
+        self.sec_per_mp = sec_per_mp
+        self.overhead_s = overhead_s
+        self.alpha = alpha
+        self.inflight = 0
+        self._lock = threading.Lock()
+
+    def calibrate(self, net, device="cpu", sizes=(256, 512), repeats=2, upsample_align=False):
+        """在 sizes 上各跑 repeats 次前向，拟合 overhead_s 和 sec_per_mp；返回 sec_per_mp"""
+        points = []
+        for s in sizes:
+            x = torch.rand(1, 3, s, s) * 2 - 1
+            forward_model(net, x, device, upsample_align)          # 预热
+            t = time.perf_counter()
+            for _ in range(repeats):
+                forward_model(net, x, device, upsample_align)
+            points.append((s * s / 1e6, (time.perf_counter() - t) / repeats))
+        (m0, t0), (m1, t1) = points[0], points[-1]
+        slope = (t1 - t0) / (m1 - m0) if m1 > m0 else 0.0
+        if slope <= 0:
+            slope = t1 / m1
+        with self._lock:
+            self.sec_per_mp = slope
+            self.overhead_s = max(0.0, t1 - slope * m1)
+        logger.info("分辨率调度标定 | sec_per_mp=%.3f overhead_s=%.3f", self.sec_per_mp, self.overhead_s)
+        return self.sec_per_mp
+
+    def calibrate_async(self, load_net, device="cpu"):
+        """后台线程里 load_net() 取模型再标定，不挡启动；标定前按 max_edge 处理"""
+        def run():
+            try:
+                self.calibrate(load_net(), device)
+            except Exception:
+                logger.warning("分辨率调度标定失败，先按 max_edge 处理，之后按实测耗时调整", exc_info=True)
+        t = threading.Thread(target=run, name="animegan-calibrate", daemon=True)
+        t.start()
+        return t
+
+    def observe(self, pixels, seconds):
+        """一次处理了 pixels 个模型输入像素、耗时 seconds，更新单价"""
+        if pixels <= 0:
+            return
+        with self._lock:
+            rate = max(seconds - self.overhead_s, 1e-6) / (pixels / 1e6)
+            if self.sec_per_mp is None:
+                self.sec_per_mp = rate
+            else:
+                self.sec_per_mp += self.alpha * (rate - self.sec_per_mp)
+
+    def plan(self, w, h, load=None, count=1):
+        """原图 (w, h) → Plan；load 默认取本调度器当前在途数，count 为这张图要跑几遍（多风格）"""
+        load = self.inflight if load is None else load
+        full = model_size(w, h, max_edge=self.max_edge, x32=True)
+        edge = self.max_edge
+        if self.target_s is not None and self.sec_per_mp is not None:
+            budget = self.target_s / (load + 1) - self.overhead_s
+            pixels = max(budget, 0.0) / self.sec_per_mp / count * 1e6
+            # 长边为 edge 时模型输入约 edge² × 短边/长边 个像素
+            edge = int(math.sqrt(pixels * max(w, h) / max(min(w, h), 1)))
+            edge = max(self.min_edge, min(self.max_edge, edge // self.step * self.step))
+        size = model_size(w, h, max_edge=edge, x32=True)
+        expected = None
+        if self.sec_per_mp is not None:
+            expected = self.overhead_s + self.sec_per_mp * size[0] * size[1] * count / 1e6
+        return Plan(edge, size, expected, load, size != full)
+
+    @contextmanager
+    def track(self, size, count=1):
+        """处理 count 张模型输入为 size=(w, h) 的图：期间计入在途数，独占且正常结束时用实际耗时更新单价"""
+        with self._lock:
+            alone = self.inflight == 0
+            self.inflight += 1
+        t = time.perf_counter()
+        try:
+            yield
+            if alone and self.inflight == 1:
+                self.observe(size[0] * size[1] * count, time.perf_counter() - t)
+        finally:
+            with self._lock:
+                self.inflight -= 1
+
+    def state(self):
+        return {"target_s": self.target_s, "max_edge": self.max_edge, "min_edge": self.min_edge,
+                "sec_per_mp": self.sec_per_mp, "overhead_s": self.overhead_s, "inflight": self.inflight}
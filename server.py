@@ -0,0 +1,443 @@
+# ================ 推理服务：asyncio HTTP + 按风格/尺寸动态合批 ================
+import os
+import json
+import time
+import asyncio
+import pathlib
+import argparse
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+import imageops
+from anime_infer import WEIGHTS_DIR, get_model, forward_model
+from metrics import Metrics, logger, render_prometheus
+from scheduler import ResolutionScheduler
+
+FORMATS = {"png": (".png", "image/png"), "jpeg": (".jpg", "image/jpeg"),
+           "jpg": (".jpg", "image/jpeg"), "webp": (".webp", "image/webp")}
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           411: "Length Required", 413: "Payload Too Large", 429: "Too Many Requests", 500: "Internal Server Error"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message=""):
+        super().__init__(message)
+        self.status = status
+        self.message = message or REASONS.get(status, "")
+
+
+class _Job:
+    __slots__ = ("x", "future", "t0")
+
+    def __init__(self, x, future):
+        self.x, self.future, self.t0 = x, future, time.perf_counter()
+
+
+# ---------- 每个风格一个合批器 + 自己的推理线程池 ----------
+class StyleBatcher:
+    """同一风格的请求按 (模型输入尺寸, align) 分桶，桶里攒够 max_batch 张或最早一张等满 max_wait 秒就出批
+
+    有空闲 worker 时才从桶里取批，worker 都忙时请求继续在桶里累积，负载越高批越大。
+    """
+
+    def __init__(self, name, net, device="cpu", workers=1, max_batch=8, max_wait=0.01, metrics=None):
+        self.name = name
+        self.device = device
+        self.net = net
+        self.workers = workers
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix=f"animegan-{name}")
+        self.buckets = OrderedDict()     # (h, w, align) -> [_Job]
+        self.queued = 0
+        self.busy = 0
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(workers)
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self.pool.shutdown(wait=True)
+
+    def submit(self, x, align):
+        """x 为 1x3xHxW [-1,1]（imageops.preprocess）；返回 future，结果为 (1x3xHxW 模型输出, 批大小, 排队秒数)"""
+        fut = asyncio.get_running_loop().create_future()
+        self.buckets.setdefault((x.shape[-2], x.shape[-1], bool(align)), []).append(_Job(x, fut))
+        self.queued += 1
+        self._wakeup.set()
+        return fut
+
+    def _pick(self, now):
+        """返回应出批的桶 key；都没到条件时返回 (None, 最近的到期时间)"""
+        best, deadline = None, None
+        for key, jobs in self.buckets.items():
+            due = jobs[0].t0 + self.max_wait
+            if len(jobs) >= self.max_batch or due <= now:
+                if best is None or jobs[0].t0 < self.buckets[best][0].t0:
+                    best = key
+            elif deadline is None or due < deadline:
+                deadline = due
+        return best, deadline
+
+    async def _run(self):
+        while True:
+            if not self.buckets:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            key, deadline = self._pick(time.perf_counter())
+            if key is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), max(deadline - time.perf_counter(), 0))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            await self._slots.acquire()
+            # 等 worker 的这段时间桶里可能又来了请求，重新挑一次
+            key, _ = self._pick(time.perf_counter())
+            if key is None:
+                key = next(iter(self.buckets))
+            jobs = self.buckets[key]
+            batch, rest = jobs[:self.max_batch], jobs[self.max_batch:]
+            if rest:
+                self.buckets[key] = rest
+            else:
+                del self.buckets[key]
+            self.queued -= len(batch)
+            asyncio.get_running_loop().create_task(self._infer(batch, key[2]))
+
+    async def _infer(self, batch, align):
+        loop = asyncio.get_running_loop()
+        t = time.perf_counter()
+        self.busy += 1
+        try:
+            x = torch.cat([j.x for j in batch])
+            out = await loop.run_in_executor(self.pool, forward_model, self.net, x, self.device, align)
+            self.metrics.observe("forward", time.perf_counter() - t)
+            self.metrics.inc("batches")
+            for i, j in enumerate(batch):
+                if not j.future.done():
+                    j.future.set_result((out[i:i + 1], len(batch), t - j.t0))
+        except Exception as e:
+            for j in batch:
+                if not j.future.done():
+                    j.future.set_exception(e)
+        finally:
+            self.busy -= 1
+            self._slots.release()
+
+
+# ---------- HTTP ----------
+async def _read_request(reader, max_body):
+    """读一个 HTTP/1.1 请求，返回 (method, path, query, headers, body)；连接已关闭返回 None"""
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, _ = line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "bad request line")
+    headers = {}
+    while True:
+        h = await reader.readline()
+        if h in (b"\r\n", b"\n", b""):
+            break
+        k, _, v = h.decode("latin-1").partition(":")
+        headers[k.strip().lower()] = v.strip()
+    # 只支持 Content-Length 定长请求体；chunked 不读的话剩下的字节会被当成下一个请求
+    if headers.get("transfer-encoding", "identity").lower() != "identity":
+        raise HTTPError(411, "chunked bodies are not supported, send Content-Length")
+    length = headers.get("content-length")
+    if length is None:
+        if method.upper() == "POST":
+            raise HTTPError(411, "POST requires Content-Length")
+        length = "0"
+    try:
+        n = int(length)
+    except ValueError:
+        n = -1
+    if n < 0:
+        raise HTTPError(400, f"bad Content-Length {length!r}")
+    if n > max_body:
+        raise HTTPError(413, f"body larger than {max_body} bytes")
+    body = await reader.readexactly(n) if n else b""
+    url = urllib.parse.urlsplit(target)
+    query = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+    return method.upper(), urllib.parse.unquote(url.path), query, headers, body
+
+
+def _write_response(writer, status, body, content_type="application/json", headers=None, keep_alive=True):
+    lines = [f"HTTP/1.1 {status} {REASONS.get(status, '')}",
+             f"Content-Type: {content_type}",
+             f"Content-Length: {len(body)}",
+             f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+    lines += [f"{k}: {v}" for k, v in (headers or {}).items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+
+
+def _json(obj):
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+class InferenceServer:
+    """POST /v1/stylize/<style>  请求体为图片字节，返回风格化后的图片（?fmt=png|jpeg|webp&align=0|1）
+    GET  /v1/styles               可用风格
+    GET  /healthz                 存活 + 各风格队列深度
+    GET  /metrics                 Prometheus 文本格式
+
+    在途请求（已接收未返回）超过 max_queue 时直接回 429，客户端按 Retry-After 重试。
+    给了 target_ms 时由 ResolutionScheduler 按在途数挑处理分辨率（不低于 min_edge），
+    响应头 X-Resolution 为实际模型输入尺寸，X-Degraded=1 表示为赶延迟降过分辨率。
+    解码/缩放和编码在共享的 io 线程池，前向在各风格自己的线程池。
+    """
+
+    def __init__(self, styles, device="cpu", workers=1, max_batch=8, max_wait_ms=10, max_queue=64,
+                 max_edge=1024, io_workers=4, max_body=32 * 1024 * 1024, target_ms=None, min_edge=256):
+        self.styles = dict(styles)        # 风格名 -> 权重路径
+        self.device = device
+        self.workers = workers
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue = max_queue
+        self.max_edge = max_edge
+        self.scheduler = ResolutionScheduler(target_ms / 1000 if target_ms else None, max_edge, min_edge)
+        self.max_body = max_body
+        self.metrics = Metrics()
+        self.io_pool = ThreadPoolExecutor(io_workers, thread_name_prefix="animegan-io")
+        self.batchers = {}
+        self.inflight = 0
+        self._server = None
+
+    async def start(self, host="127.0.0.1", port=8765):
+        loop = asyncio.get_running_loop()
+        for name, ckpt in self.styles.items():
+            # 加载权重放到线程里，不卡事件循环
+            net = await loop.run_in_executor(None, get_model, ckpt, self.device)
+            b = StyleBatcher(name, net, self.device, self.workers, self.max_batch, self.max_wait, self.metrics)
+            b.start()
+            self.batchers[name] = b
+            if self.scheduler.target_s is not None and self.scheduler.sec_per_mp is None:
+                await loop.run_in_executor(None, self.scheduler.calibrate, net, self.device)
+        self._server = await asyncio.start_server(self._handle, host, port)
+        return self._server.sockets[0].getsockname()[:2]
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        for b in self.batchers.values():
+            await b.stop()
+        self.io_pool.shutdown(wait=True)
+
+    async def serve_forever(self):
+        async with self._server:
+            await self._server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                req = None
+                try:
+                    req = await _read_request(reader, self.max_body)
+                    if req is None:
+                        break
+                    method, path, query, headers, body = req
+                    keep_alive = headers.get("connection", "").lower() != "close"
+                    status, ctype, payload, extra = await self._dispatch(method, path, query, body)
+                except HTTPError as e:
+                    # 请求本身没读完整（坏请求行 / 长度 / chunked / 超大）时流已错位，回完错误就断开
+                    keep_alive = req is not None and e.status < 500
+                    status, ctype, payload, extra = e.status, "application/json", _json({"error": e.message}), {}
+                    if e.status == 429:
+                        extra = {"Retry-After": "1"}
+                _write_response(writer, status, payload, ctype, extra, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, path, query, body):
+        if path == "/healthz":
+            return 200, "application/json", _json(self.health()), {}
+        if path == "/metrics":
+            return 200, "text/plain; version=0.0.4", self.render_metrics().encode(), {}
+        if path == "/v1/styles":
+            return 200, "application/json", _json(sorted(self.batchers)), {}
+        if path.startswith("/v1/stylize/"):
+            if method != "POST":
+                raise HTTPError(405, "use POST")
+            style = path[len("/v1/stylize/"):]
+            style = style[:-3] if style.endswith(".pt") else style
+            return await self.stylize(style, body, query.get("fmt", "png").lower(), query.get("align", "0") == "1")
+        raise HTTPError(404, f"no route {path}")
+
+    async def stylize(self, style, data, fmt="png", align=False):
+        batcher = self.batchers.get(style)
+        if batcher is None:
+            raise HTTPError(404, f"unknown style {style!r}, have {sorted(self.batchers)}")
+        if fmt not in FORMATS:
+            raise HTTPError(400, f"fmt must be one of {sorted(FORMATS)}")
+        if self.inflight >= self.max_queue:
+            self.metrics.inc("rejected")
+            raise HTTPError(429, "queue full")
+        loop = asyncio.get_running_loop()
+        load = self.inflight
+        self.inflight += 1
+        t = time.perf_counter()
+        try:
+            try:
+                x, size, plan = await loop.run_in_executor(self.io_pool, self._decode, data, load)
+            except Exception as e:
+                self.metrics.inc("failed")
+                raise HTTPError(400, f"cannot decode image: {e}")
+            try:
+                out, batch, queued = await batcher.submit(x, align)
+                payload = await loop.run_in_executor(self.io_pool, self._encode, out, size, FORMATS[fmt][0])
+            except Exception as e:
+                self.metrics.inc("failed")
+                logger.exception("推理失败 | style=%s", style)
+                raise HTTPError(500, repr(e))
+            total = time.perf_counter() - t
+            if load == 0 and self.inflight == 1:
+                # 只采独占时的耗时；同批的图一起算完，按整批像素记
+                self.scheduler.observe(plan.size[0] * plan.size[1] * batch, total - queued)
+            self.metrics.inc("processed")
+            if plan.degraded:
+                self.metrics.inc("degraded")
+            self.metrics.observe("request", total)
+            self.metrics.observe("queue", queued)
+            return 200, FORMATS[fmt][1], payload, {
+                "X-Batch-Size": str(batch), "X-Queue-Ms": f"{queued * 1000:.1f}",
+                "X-Total-Ms": f"{total * 1000:.1f}", "X-Resolution": str(plan),
+                "X-Degraded": str(int(plan.degraded))}
+        finally:
+            self.inflight -= 1
+
+    def _decode(self, data, load=0):
+        t = time.perf_counter()
+        img = imageops.decode(data)
+        h, w = img.shape[-2:]
+        plan = self.scheduler.plan(w, h, load)
+        x = imageops.preprocess([img], plan.size)
+        self.metrics.observe("decode", time.perf_counter() - t)
+        return x, (h, w), plan
+
+    def _encode(self, out, size, ext):
+        t = time.perf_counter()
+        (img,), _ = imageops.postprocess(out, [size])
+        data = imageops.encode(img, ext)
+        self.metrics.observe("encode", time.perf_counter() - t)
+        return data
+
+    def health(self):
+        return {"status": "ok", "inflight": self.inflight, "max_queue": self.max_queue,
+                "styles": {n: {"queued": b.queued, "busy": b.busy, "workers": b.workers}
+                           for n, b in self.batchers.items()},
+                "scheduler": self.scheduler.state()}
+
+    def render_metrics(self):
+        gauges = {"inflight": self.inflight,
+                  "queued": {f'style="{n}"': b.queued for n, b in self.batchers.items()},
+                  "busy_workers": {f'style="{n}"': b.busy for n, b in self.batchers.items()}}
+        if self.scheduler.sec_per_mp is not None:
+            gauges["sec_per_megapixel"] = self.scheduler.sec_per_mp
+        return render_prometheus(self.metrics.snapshot(), gauges=gauges)
+
+
+def discover_styles(weights_dir=WEIGHTS_DIR, only=None):
+    """weights 目录下的 *.pt，风格名为文件名去掉 .pt"""
+    styles = {p.stem: str(p) for p in sorted(pathlib.Path(weights_dir).glob("*.pt"))}
+    if only:
+        styles = {k: v for k, v in styles.items() if k in only}
+    return styles
+
+
+# ---------- 客户端：app.py / GUI 设了 ANIMEGAN_SERVER 时走这里 ----------
+def server_url():
+    return os.environ.get("ANIMEGAN_SERVER") or None
+
+
+def stylize_remote(data, style, server=None, fmt="png", align=False, timeout=120, retries=3, with_info=False):
+    """把图片字节发给推理服务，返回结果图片字节；429 时按 Retry-After 重试
+
+    with_info=True 时返回 (字节, {"resolution": "WxH", "degraded": bool})，分辨率由服务端调度决定。
+    """
+    server = server or server_url()
+    if not server:
+        raise RuntimeError("未指定推理服务地址（参数 server 或环境变量 ANIMEGAN_SERVER）")
+    style = pathlib.Path(style).stem
+    url = (f"{server.rstrip('/')}/v1/stylize/{urllib.parse.quote(style)}"
+           f"?fmt={fmt}&align={int(bool(align))}")
+    for attempt in range(retries + 1):
+        req = urllib.request.Request(url, data=bytes(data), method="POST",
+                                     headers={"Content-Type": "application/octet-stream"})
+        try:
+            with urllib.request.urlopen(req, timeout=timeout) as r:
+                body = r.read()
+                if not with_info:
+                    return body
+                return body, {"resolution": r.headers.get("X-Resolution"),
+                              "degraded": r.headers.get("X-Degraded") == "1"}
+        except urllib.error.HTTPError as e:
+            if e.code == 429 and attempt < retries:
+                time.sleep(float(e.headers.get("Retry-After", 1)))
+                continue
+            raise RuntimeError(f"推理服务返回 {e.code}: {e.read().decode('utf-8', 'replace')}") from e
+
+
+async def _main(args):
+    styles = discover_styles(args.weights_dir, args.styles)
+    if not styles:
+        raise SystemExit(f"{args.weights_dir} 下没有可用的 .pt 权重")
+    srv = InferenceServer(styles, args.device, args.workers, args.max_batch, args.max_wait_ms,
+                          args.max_queue, args.max_edge, args.io_workers, target_ms=args.target_ms,
+                          min_edge=args.min_edge)
+    host, port = await srv.start(args.host, args.port)
+    logger.info("推理服务已启动 http://%s:%s 风格=%s", host, port, sorted(styles))
+    try:
+        await srv.serve_forever()
+    finally:
+        await srv.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--weights_dir', type=str, default=str(WEIGHTS_DIR))
+    parser.add_argument('--styles', type=str, nargs='*', default=None, help='只加载这些风格（文件名去掉 .pt）')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--workers', type=int, default=1, help='每个风格的推理线程数')
+    parser.add_argument('--max-batch', type=int, default=8, help='单批最多张数')
+    parser.add_argument('--max-wait-ms', type=float, default=10, help='请求最多等多久凑批')
+    parser.add_argument('--max-queue', type=int, default=64, help='在途请求上限，超过回 429')
+    parser.add_argument('--max-edge', type=int, default=1024, help='空闲时的处理分辨率（长边）')
+    parser.add_argument('--target-ms', type=float, default=None,
+                        help='目标处理延迟，给了就按负载自动降分辨率（不给则固定 --max-edge）')
+    parser.add_argument('--min-edge', type=int, default=256, help='降分辨率的下限（长边）')
+    parser.add_argument('--io-workers', type=int, default=4, help='解码/编码线程数')
+    args = parser.parse_args()
+    import logging
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s")
+    try:
+        asyncio.run(_main(args))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,96 @@
+# ================ 结果缓存 / 增量同步 / 分桶的回归测试（随机初始化权重，离线可跑） ================
+import os
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+from anime_infer import convert_dir, get_model, plan_batches
+from manifest import open_manifest
+from metrics import Metrics
+from model import Generator
+from result_cache import ResultCache, make_policy
+
+
+def _image(path, w, h, seed=0):
+    Image.fromarray(np.random.RandomState(seed).randint(0, 256, (h, w, 3), dtype=np.uint8)).save(path)
+
+
+@pytest.fixture
+def checkpoint(tmp_path):
+    torch.manual_seed(0)
+    path = tmp_path / "random.pt"
+    torch.save(Generator().state_dict(), path)
+    return str(path)
+
+
+def _sync(checkpoint, src, out):
+    manifest = open_manifest(str(out), checkpoint)
+    metrics = Metrics()
+    convert_dir(get_model(checkpoint), str(src), str(out), checkpoint=checkpoint,
+                manifest=manifest, metrics=metrics)
+    return manifest.summary(), metrics.snapshot()["counters"].get("processed", 0)
+
+
+def test_sync_round_trip(tmp_path, checkpoint):
+    src, out = tmp_path / "in", tmp_path / "out"
+    src.mkdir()
+    _image(src / "a.png", 64, 64, seed=1)
+    _image(src / "b.png", 96, 64, seed=2)
+
+    assert _sync(checkpoint, src, out) == ({"skipped": 0, "stale": 0, "new": 2}, 2)
+    assert sorted(os.listdir(out)) == [".animegan_manifest.jsonl", "a.png", "b.png"]
+
+    # 什么都没变
+    assert _sync(checkpoint, src, out) == ({"skipped": 2, "stale": 0, "new": 0}, 0)
+
+    # 只改 mtime，内容哈希相同：跳过，并记下新 mtime，下次不再算哈希
+    st = os.stat(src / "a.png")
+    os.utime(src / "a.png", ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert _sync(checkpoint, src, out) == ({"skipped": 2, "stale": 0, "new": 0}, 0)
+    assert open_manifest(str(out), checkpoint).entries["a.png"]["mtime_ns"] == st.st_mtime_ns + 10 ** 9
+
+    # 内容变了：重做
+    _image(src / "a.png", 64, 64, seed=3)
+    assert _sync(checkpoint, src, out) == ({"skipped": 1, "stale": 1, "new": 0}, 1)
+
+
+def test_cache_hit_miss_evict(tmp_path, checkpoint):
+    cache = ResultCache(tmp_path / "cache", max_bytes=250)
+    key = cache.make_key(b"input", checkpoint, make_policy(1024), False)
+    assert key != cache.make_key(b"input", checkpoint, make_policy(512), False)
+    assert key != cache.make_key(b"input", checkpoint, make_policy(1024), True)
+
+    assert cache.get(key) is None
+    cache.put(key, b"x" * 100)
+    assert cache.get(key) == b"x" * 100
+
+    k2, k3 = (cache.make_key(bytes([i]), checkpoint, make_policy(1024), False) for i in range(2))
+    cache.put(k2, b"y" * 100)
+    for i, k in enumerate([key, k2]):
+        os.utime(cache._path(k), (1000 + i, 1000 + i))
+    cache.put(k3, b"z" * 100)          # 300 > 250：按 mtime 淘汰最旧的 key，降到 90% 以下
+    assert cache.get(key) is None
+    assert cache.get(k2) == b"y" * 100
+    assert cache.get(k3) == b"z" * 100
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["puts"], stats["evictions"]) == (3, 2, 3, 1)
+    assert stats["bytes"] == 200
+
+
+def test_plan_batches_buckets(tmp_path):
+    paths = []
+    for i, (w, h) in enumerate([(64, 64), (96, 64), (64, 64), (70, 66), (96, 64), (64, 64)]):
+        paths.append(str(tmp_path / f"{i}.png"))
+        _image(paths[-1], w, h, seed=i)
+    bad = tmp_path / "bad.png"
+    bad.write_bytes(b"not an image")
+    paths.append(str(bad))
+
+    # 70x66 向下取整到 64x64，和 64x64 同桶；按 batch_size 切批，读不出头的图单独一批
+    assert plan_batches(paths, batch_size=2) == [
+        [paths[0], paths[2]], [paths[3], paths[5]], [paths[1], paths[4]], [str(bad)]]
+    # 总像素上限优先于 batch_size
+    assert plan_batches(paths[:3], batch_size=8, max_batch_pixels=64 * 64) == [[paths[0]], [paths[2]], [paths[1]]]
@@ -0,0 +1,49 @@
+# ================ imageops 解码 / 预处理的回归测试 ================
+import io
+
+import numpy as np
+import pytest
+import torch
+from PIL import Image
+
+import imageops
+from anime_infer import convert_dir, get_model, model_size
+from metrics import Metrics
+from model import Generator
+
+
+def _png16(w, h, seed=0):
+    """16 位灰度 PNG，torchvision 解出来是 uint16"""
+    a = np.random.RandomState(seed).randint(0, 65536, (h, w)).astype(np.uint16)
+    buf = io.BytesIO()
+    Image.fromarray(a).save(buf, format="PNG")
+    return a, buf.getvalue()
+
+
+def test_decode_16bit_png_to_u8():
+    a, data = _png16(70, 50)
+    x = imageops.decode(data)
+    assert x.dtype == torch.uint8 and tuple(x.shape) == (3, 50, 70)
+    expected = torch.from_numpy(np.round(a / 257).astype(np.uint8))
+    assert (x[0].int() - expected.int()).abs().max() <= 1
+    assert torch.equal(x[0], x[2])
+
+
+@pytest.mark.parametrize("w,h", [(64, 64), (70, 50)])        # 32 倍数不插值 / 要插值
+def test_convert_dir_16bit_png(tmp_path, w, h):
+    src, out = tmp_path / "in", tmp_path / "out"
+    src.mkdir()
+    (src / "deep.png").write_bytes(_png16(w, h)[1])
+    torch.manual_seed(0)
+    ckpt = tmp_path / "random.pt"
+    torch.save(Generator().state_dict(), ckpt)
+    net = get_model(str(ckpt))
+
+    x = imageops.preprocess([imageops.load(str(src / "deep.png"))], model_size(w, h))
+    assert x.min() >= -1 and x.max() <= 1
+
+    metrics = Metrics()
+    convert_dir(net, str(src), str(out), metrics=metrics)
+    counters = metrics.snapshot()["counters"]
+    assert counters["processed"] == 1 and "failed" not in counters
+    assert Image.open(out / "deep.png").size == (w, h)
@@ -0,0 +1,192 @@
+# ================ 分块推理：大图不降采样，内存有界 ================
+import os
+import copy
+import contextlib
+
+import torch
+import torch.nn.functional as F
+from torch import nn
+
+import imageops
+from anime_infer import get_model, list_images, model_size, output_path, _to_u8, _like_input, _report_failure
+from metrics import NULL_METRICS
+
+# no_grad 下 Generator 每个输入像素的峰值激活字节数（全分辨率 128 通道的 pad + conv 输出占大头），偏保守
+BYTES_PER_PIXEL = 2048
+# 一行 tile 的拼接缓冲每像素字节数：3 通道 float 累加 + 1 通道 float 权重
+BAND_BYTES_PER_PIXEL = 16
+
+
+def tile_size_for_budget(budget_bytes, overlap=64, min_tile=128, width=0):
+    """按内存预算挑最大的 32 对齐方形 tile 边长
+
+    预算 = tile 前向的激活 (BYTES_PER_PIXEL * tile²) + 一行 tile 的拼接缓冲 (BAND_BYTES_PER_PIXEL * tile * width)，
+    width 为图宽，0 表示不计缓冲。uint8 的原图和结果（各 3 字节/像素）不在预算内。
+    """
+    a, b = BYTES_PER_PIXEL, BAND_BYTES_PER_PIXEL * width
+    edge = int((-b + (b * b + 4 * a * budget_bytes) ** 0.5) / (2 * a)) // 32 * 32
+    return max(edge, min_tile, overlap * 2 + 32)
+
+
+def _starts(length, tile, overlap):
+    if length <= tile:
+        return [0]
+    stride = tile - overlap
+    starts = list(range(0, length - tile, stride))
+    starts.append(length - tile)
+    return starts
+
+
+def _ramp(n, overlap, head, tail):
+    w = torch.ones(n)
+    if overlap > 0:
+        r = (torch.arange(overlap, dtype=torch.float32) + 0.5) / overlap
+        if head:
+            w[:overlap] = r
+        if tail:
+            w[-overlap:] = r.flip(0)
+    return w
+
+
+# ---------- GroupNorm 统计量：低分辨率整图算一次，所有 tile 复用 ----------
+def _group_norms(net):
+    return [m for m in net.modules() if isinstance(m, nn.GroupNorm)]
+
+
+@contextlib.contextmanager
+def _record_norm_stats(net, store):
+    """前向时记录每个 GroupNorm 输入的 (mean, var)，按组统计"""
+    def hook(m, inp, _):
+        x = inp[0]
+        g = x.view(x.size(0), m.num_groups, -1)
+        store[m] = (g.mean(-1), g.var(-1, unbiased=False))
+    handles = [m.register_forward_hook(hook) for m in _group_norms(net)]
+    try:
+        yield store
+    finally:
+        for h in handles:
+            h.remove()
+
+
+def _frozen_forward(m, mean, var):
+    def fwd(x):
+        b, c = x.shape[:2]
+        g = x.view(b, m.num_groups, -1)
+        g = (g - mean[..., None]) * torch.rsqrt(var[..., None] + m.eps)
+        out = g.view_as(x)
+        if m.affine:
+            shape = (1, c) + (1,) * (x.dim() - 2)
+            out = out * m.weight.view(shape) + m.bias.view(shape)
+        return out
+    return fwd
+
+
+@contextlib.contextmanager
+def _frozen_norm_stats(net, store):
+    """临时让每个 GroupNorm 用 store 里的统计量归一化，退出时恢复"""
+    mods = _group_norms(net)
+    for m in mods:
+        mean, var = store[m]
+        m.forward = _frozen_forward(m, mean, var)
+    try:
+        yield
+    finally:
+        for m in mods:
+            m.__dict__.pop("forward", None)
+
+
+def _x32_pad(x):
+    h, w = x.shape[-2:]
+    ph, pw = (-h) % 32, (-w) % 32
+    if ph or pw:
+        mode = "reflect" if ph < h and pw < w else "replicate"
+        x = F.pad(x, (0, pw, 0, ph), mode=mode)
+    return x, (h, w)
+
+
+def _forward_patch(net, patch, device, upsample_align):
+    """3xthxtw uint8 → 3xthxtw [-1,1] float；边长不是 32 倍数时（图比 tile 小）先 pad 再裁回"""
+    x, (h, w) = _x32_pad(patch.unsqueeze(0).float().mul_(2 / 255).sub_(1))
+    out = net(x.to(device), upsample_align).float().cpu()
+    return out[0, :, :h, :w].clamp_(-1, 1)
+
+
+def tiled_forward(net, u8, tile=512, overlap=64, device="cpu", upsample_align=False,
+                  norm="global", stats_edge=512):
+    """3xHxW uint8 进，同尺寸 uint8 出；按 tile 切块前向，重叠区线性羽化拼接
+
+    tile 直接从 uint8 原图切出再转 float，拼接只保留当前一行 tile 的 float 缓冲：
+    下一行 tile 起点之前的行不会再被写到，转成 uint8 写进结果后缓冲上移，
+    全分辨率的只有 uint8 原图和结果。
+
+    norm="tile"   每块各自算 GroupNorm 统计量（块间色调可能不一致）
+    norm="global" 先把整图缩到 stats_edge 跑一遍记录统计量，所有块复用，块间一致
+    """
+    tile = max(32, tile // 32 * 32)
+    overlap = min(overlap, tile // 2)
+    H, W = u8.shape[-2:]
+
+    store = {}
+    norm_ctx = contextlib.nullcontext()
+    if norm == "global":
+        # 要改 GroupNorm 的 forward，拷一份，避免影响注册表里被其他线程共用的模型
+        net = copy.deepcopy(net)
+        sw, sh = model_size(W, H, max_edge=stats_edge, x32=True)
+        small = imageops.preprocess([u8], (max(sw, 32), max(sh, 32)))
+        with torch.no_grad(), _record_norm_stats(net, store):
+            net(small.to(device), upsample_align)
+        store = {m: (mean.to(device), var.to(device)) for m, (mean, var) in store.items()}
+        norm_ctx = _frozen_norm_stats(net, store)
+    elif norm != "tile":
+        raise ValueError(f"未知 norm 模式: {norm}")
+
+    th, tw = min(tile, H), min(tile, W)
+    ys, xs = _starts(H, tile, overlap), _starts(W, tile, overlap)
+    result = torch.empty(3, H, W, dtype=torch.uint8)
+    acc = torch.zeros(3, th, W)
+    wsum = torch.zeros(1, th, W)
+    with torch.no_grad(), norm_ctx:
+        for i, y0 in enumerate(ys):
+            wy = _ramp(th, overlap, y0 > 0, y0 + th < H)
+            for x0 in xs:
+                wx = _ramp(tw, overlap, x0 > 0, x0 + tw < W)
+                out = _forward_patch(net, u8[:, y0:y0 + th, x0:x0 + tw], device, upsample_align)
+                wt = (wy[:, None] * wx[None, :])[None]
+                acc[:, :, x0:x0 + tw] += out * wt
+                wsum[:, :, x0:x0 + tw] += wt
+            ny = ys[i + 1] if i + 1 < len(ys) else H
+            n = ny - y0
+            result[:, y0:ny] = imageops.to_u8(acc[:, :n] / wsum[:, :n])
+            acc = torch.cat([acc[:, n:], acc.new_zeros(3, n, W)], 1)
+            wsum = torch.cat([wsum[:, n:], wsum.new_zeros(1, n, W)], 1)
+    return result
+
+
+def infer_tiled(image, checkpoint, device="cpu", upsample_align=False,
+                budget_bytes=1024 * 1024 * 1024, overlap=64, norm="global", tile=None, fmt="PNG"):
+    """全分辨率推理，输入输出类型同 anime_infer.infer（PIL / uint8 数组 / bytes）；tile 为空时按 budget_bytes 自动挑"""
+    net = get_model(checkpoint, device)
+    u8 = _to_u8(image)
+    tile = tile or tile_size_for_budget(budget_bytes, overlap, width=u8.shape[-1])
+    return _like_input(image, tiled_forward(net, u8, tile, overlap, device, upsample_align, norm), fmt)
+
+
+def convert_dir_tiled(checkpoint, input_dir, output_dir, device="cpu", upsample_align=False,
+                      budget_bytes=1024 * 1024 * 1024, overlap=64, norm="global", recursive=False,
+                      metrics=NULL_METRICS):
+    """目录批量分块推理；单张失败只记录，不影响其余图"""
+    net = get_model(checkpoint, device)
+    for name in list_images(input_dir, recursive):
+        path = os.path.join(input_dir, name)
+        try:
+            with metrics.timer("load"):
+                u8 = imageops.load(path)
+            tile = tile_size_for_budget(budget_bytes, overlap, width=u8.shape[-1])
+            with metrics.timer("forward"):
+                out = tiled_forward(net, u8, tile, overlap, device, upsample_align, norm)
+            with metrics.timer("save"):
+                imageops.save(out, output_path(path, output_dir, input_dir))
+        except Exception as e:
+            _report_failure(metrics, path, e)
+            continue
+        metrics.inc("processed")
@@ -0,0 +1,249 @@
+# ================ 视频 / 帧序列风格化：流式解码、批量推理、相似帧复用 ================
+import os
+import json
+import time
+import shutil
+import argparse
+import subprocess
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+from anime_infer import get_model, list_images, model_size, forward, restore_size
+
+FFMPEG = os.environ.get("ANIMEGAN_FFMPEG", "ffmpeg")
+FFPROBE = os.environ.get("ANIMEGAN_FFPROBE", "ffprobe")
+
+
+def _require(exe):
+    if shutil.which(exe) is None:
+        raise RuntimeError(f"找不到 {exe}，请先安装 ffmpeg 或用 ANIMEGAN_FFMPEG / ANIMEGAN_FFPROBE 指定路径")
+
+
+# ---------- 输入：视频（ffmpeg 管道）或图片目录 ----------
+def probe(path):
+    """返回视频解码后（已按旋转元数据转正）的 (宽, 高, 帧率)
+
+    ffmpeg 默认按 rotate 标签 / display matrix 自动旋转，手机竖拍的视频编码尺寸是横的，
+    转 90°/270° 后宽高互换，要和 iter_video_frames 实际读出的帧一致。
+    """
+    _require(FFPROBE)
+    out = subprocess.run([FFPROBE, "-v", "error", "-select_streams", "v:0",
+                          "-show_entries", "stream=width,height,r_frame_rate:stream_tags=rotate"
+                          ":stream_side_data=rotation", "-of", "json", path],
+                         check=True, capture_output=True).stdout
+    st = json.loads(out)["streams"][0]
+    num, _, den = st["r_frame_rate"].partition("/")
+    w, h = int(st["width"]), int(st["height"])
+    rotation = st.get("tags", {}).get("rotate")
+    for sd in st.get("side_data_list", []):
+        rotation = sd.get("rotation", rotation)
+    if round(float(rotation or 0)) % 180 == 90:
+        w, h = h, w
+    return w, h, float(num) / float(den or 1)
+
+
+def iter_video_frames(path, width, height):
+    """ffmpeg 解成 rgb24 原始帧经管道逐帧读出，不落盘；yield HxWx3 uint8"""
+    _require(FFMPEG)
+    proc = subprocess.Popen([FFMPEG, "-v", "error", "-i", path, "-f", "rawvideo", "-pix_fmt", "rgb24", "-"],
+                            stdout=subprocess.PIPE)
+    frame_bytes = width * height * 3
+    try:
+        while True:
+            buf = bytearray(frame_bytes)          # 可写缓冲，转张量时不用再拷一份
+            n = 0
+            while n < frame_bytes:
+                got = proc.stdout.readinto(memoryview(buf)[n:])
+                if not got:
+                    return
+                n += got
+            yield np.frombuffer(buf, dtype=np.uint8).reshape(height, width, 3)
+    finally:
+        proc.stdout.close()
+        proc.kill()
+        proc.wait()
+
+
+def iter_sequence_frames(input_dir):
+    for name in list_images(input_dir):
+        with Image.open(os.path.join(input_dir, name)) as img:
+            yield np.asarray(img.convert("RGB"))
+
+
+# ---------- 输出 ----------
+class VideoWriter:
+    """rgb24 原始帧写进 ffmpeg 管道编码成 H.264；给了 audio_from 时把原视频的音轨一起带上"""
+
+    def __init__(self, path, width, height, fps, audio_from=None, crf=18):
+        _require(FFMPEG)
+        cmd = [FFMPEG, "-v", "error", "-y", "-f", "rawvideo", "-pix_fmt", "rgb24",
+               "-s", f"{width}x{height}", "-r", f"{fps}", "-i", "-"]
+        if audio_from:
+            cmd += ["-i", audio_from, "-map", "0:v", "-map", "1:a?", "-c:a", "copy", "-shortest"]
+        cmd += ["-c:v", "libx264", "-crf", str(crf), "-pix_fmt", "yuv420p", path]
+        self.proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        self.proc.stdin.write(np.ascontiguousarray(frame).tobytes())
+
+    def close(self):
+        self.proc.stdin.close()
+        if self.proc.wait() != 0:
+            raise RuntimeError(f"ffmpeg 编码失败，返回码 {self.proc.returncode}")
+
+
+class SequenceWriter:
+    def __init__(self, output_dir, fmt="frame_{:06d}.png"):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir, self.fmt, self.index = output_dir, fmt, 0
+
+    def write(self, frame):
+        self.index += 1
+        Image.fromarray(frame).save(os.path.join(self.output_dir, self.fmt.format(self.index)))
+
+    def close(self):
+        pass
+
+
+# ---------- 相似帧检测 ----------
+class FrameSkipper:
+    """把帧缩成 size 宽的灰度小图，和上一张真正推理过的帧比平均绝对差
+
+    只和关键帧比而不是和前一帧比，缓慢变化的镜头不会因为逐帧累积而一直被跳过。
+    帧尺寸和关键帧不同时一律不复用（输出尺寸对不上），该帧成为新的关键帧。
+    """
+
+    def __init__(self, threshold=0.01, size=64):
+        self.threshold = threshold
+        self.size = size
+        self.key = None
+        self.key_size = None
+
+    def _thumb(self, x):
+        h, w = x.shape[-2:]
+        th = max(1, round(self.size * h / w))
+        return F.interpolate(x.mean(1, keepdim=True), size=(th, self.size), mode="area")
+
+    def should_reuse(self, x):
+        """x 为 1x3xHxW [0,1]；返回 True 表示可以复用上一张关键帧的输出"""
+        if self.threshold <= 0:
+            return False
+        t = self._thumb(x)
+        size = tuple(x.shape[-2:])
+        if (self.key is not None and size == self.key_size and t.shape == self.key.shape
+                and (t - self.key).abs().mean().item() < self.threshold):
+            return True
+        self.key, self.key_size = t, size
+        return False
+
+
+# ---------- 主流程 ----------
+def _to_tensor(frame):
+    return torch.from_numpy(np.ascontiguousarray(frame)).permute(2, 0, 1).unsqueeze(0).float() / 255
+
+
+def _to_frame(out):
+    return (out.squeeze(0).clamp(0, 1) * 255).round().byte().permute(1, 2, 0).numpy()
+
+
+def stylize_frames(net, frames, device="cpu", upsample_align=False, batch_size=4,
+                   max_edge=1024, skip_threshold=0.01, stats=None):
+    """逐帧 yield 风格化后的 HxWx3 uint8，输出尺寸同输入
+
+    需要推理的帧攒够 batch_size 张（或遇到尺寸变化）一起前向；相似帧只记一个占位，
+    复用最近关键帧的输出。待输出的帧（含占位）满 batch_size 张也会 flush，静止镜头不会一直攒着不出帧；
+    内存里最多 batch_size 张待推理帧，和视频长度无关。
+    """
+    stats = stats if stats is not None else {"frames": 0, "computed": 0, "reused": 0}
+    skipper = FrameSkipper(skip_threshold)
+    pending = []          # 待推理的 (模型尺寸张量, 原始 (h, w))，None 表示复用
+    last_out = None
+
+    def flush():
+        nonlocal last_out
+        todo = [p for p in pending if p is not None]
+        outs = iter(())
+        if todo:
+            out = forward(net, torch.cat([x for x, _ in todo]), device, upsample_align)
+            outs = iter([_to_frame(restore_size(o.unsqueeze(0), size)) for o, (_, size) in zip(out, todo)])
+        for p in pending:
+            if p is not None:
+                last_out = next(outs)
+            yield last_out
+        pending.clear()
+
+    for frame in frames:
+        stats["frames"] += 1
+        x = _to_tensor(frame)
+        if skipper.should_reuse(x):
+            stats["reused"] += 1
+            pending.append(None)
+            if len(pending) >= batch_size:
+                yield from flush()
+            continue
+        oh, ow = x.shape[-2:]
+        nw, nh = model_size(ow, oh, max_edge=max_edge, x32=True)
+        if (nw, nh) != (ow, oh):
+            x = F.interpolate(x, size=(nh, nw), mode="bilinear", align_corners=False, antialias=True)
+        computed = [p for p in pending if p is not None]
+        if computed and computed[0][0].shape != x.shape:
+            yield from flush()
+        stats["computed"] += 1
+        pending.append((x, (oh, ow)))
+        if len(pending) >= batch_size:
+            yield from flush()
+    yield from flush()
+
+
+def convert_video(checkpoint, src, dst, device="cpu", upsample_align=False, batch_size=4,
+                  max_edge=1024, skip_threshold=0.01, keep_audio=True, crf=18):
+    """src/dst 为视频文件或图片目录（帧序列），返回统计 dict"""
+    net = get_model(checkpoint, device)
+    stats = {"frames": 0, "computed": 0, "reused": 0}
+    if os.path.isdir(src):
+        frames = iter_sequence_frames(src)
+        fps, size = 25.0, None
+    else:
+        w, h, fps = probe(src)
+        frames = iter_video_frames(src, w, h)
+        size = (w, h)
+
+    writer = None
+    t = time.perf_counter()
+    try:
+        for out in stylize_frames(net, frames, device, upsample_align, batch_size,
+                                  max_edge, skip_threshold, stats):
+            if writer is None:
+                if os.path.splitext(dst)[-1]:
+                    h, w = out.shape[:2]
+                    writer = VideoWriter(dst, w, h, fps, src if keep_audio and size else None, crf)
+                else:
+                    writer = SequenceWriter(dst)
+            writer.write(out)
+    finally:
+        if writer is not None:
+            writer.close()
+    stats["seconds"] = time.perf_counter() - t
+    stats["fps"] = stats["frames"] / stats["seconds"] if stats["seconds"] else 0.0
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkpoint', type=str, default='./weights/paprika.pt')
+    parser.add_argument('--input', type=str, required=True, help='视频文件或帧序列目录')
+    parser.add_argument('--output', type=str, required=True, help='输出视频文件（带扩展名）或帧目录')
+    parser.add_argument('--device', type=str, default='cpu')
+    parser.add_argument('--upsample_align', action='store_true')
+    parser.add_argument('--batch-size', type=int, default=4)
+    parser.add_argument('--max-edge', type=int, default=1024, help='推理分辨率的长边上限')
+    parser.add_argument('--skip-threshold', type=float, default=0.01,
+                        help='低分辨率灰度平均差小于此值的帧复用上一张输出，0 表示不跳帧')
+    parser.add_argument('--no-audio', action='store_true')
+    parser.add_argument('--crf', type=int, default=18)
+    args = parser.parse_args()
+    print(convert_video(args.checkpoint, args.input, args.output, args.device, args.upsample_align,
+                        args.batch_size, args.max_edge, args.skip_threshold, not args.no_audio, args.crf))
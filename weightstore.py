@@ -0,0 +1,113 @@
+# ================ 权重存储：mmap 零拷贝加载 + sha256 校验 ================
+import os
+import argparse
+import pathlib
+import tempfile
+import zipfile
+
+import torch
+
+from model import Generator
+from metrics import logger
+from result_cache import checkpoint_hash
+
+SIDECAR_SUFFIX = ".sha256"
+
+
+class IntegrityError(RuntimeError):
+    """权重内容和旁边 .sha256 记录的不一致（文件损坏或被替换）"""
+
+
+def sidecar_path(checkpoint):
+    return str(checkpoint) + SIDECAR_SUFFIX
+
+
+def write_sidecar(checkpoint):
+    """按 sha256sum 的格式写 <权重>.sha256，返回哈希"""
+    digest = checkpoint_hash(checkpoint)
+    with open(sidecar_path(checkpoint), "w", encoding="utf-8") as f:
+        f.write(f"{digest}  {os.path.basename(checkpoint)}\n")
+    return digest
+
+
+def read_sidecar(checkpoint):
+    try:
+        with open(sidecar_path(checkpoint), encoding="utf-8") as f:
+            return f.read().split()[0]
+    except (OSError, IndexError):
+        return None
+
+
+def verify(checkpoint):
+    """有 .sha256 时校验，不一致抛 IntegrityError；返回 True（已校验）/ False（没有记录）"""
+    expected = read_sidecar(checkpoint)
+    if expected is None:
+        return False
+    actual = checkpoint_hash(checkpoint)
+    if actual != expected:
+        raise IntegrityError(f"{checkpoint} 的 sha256 为 {actual}，与记录的 {expected} 不一致")
+    return True
+
+
+def is_mmappable(checkpoint):
+    """torch.save 的 zip 格式才能 mmap；老的 legacy pickle 格式需要先 convert"""
+    return zipfile.is_zipfile(checkpoint)
+
+
+def load_state_dict(checkpoint, check=True, mmap=True):
+    """读 state_dict；zip 格式时张量直接映射文件页，不拷贝、不占私有内存
+
+    映射是写时复制的，同一台机器上加载同一文件的所有进程共享页缓存里的这份权重。
+    """
+    if check:
+        verify(checkpoint)
+    if mmap and is_mmappable(checkpoint):
+        return torch.load(checkpoint, map_location="cpu", mmap=True, weights_only=True)
+    if mmap:
+        logger.info("%s 为旧格式，无法 mmap，整份读入；可用 weightstore.py --convert 升级", checkpoint)
+    return torch.load(checkpoint, map_location="cpu")
+
+
+def load_generator(checkpoint, check=True, mmap=True):
+    """Generator 的参数直接指向 load_state_dict 返回的张量（assign=True），不再拷一份"""
+    net = Generator()
+    net.load_state_dict(load_state_dict(checkpoint, check, mmap), assign=mmap)
+    return net.eval()
+
+
+def convert(checkpoint, dst=None):
+    """把权重重存成可 mmap 的 zip 格式（默认原地替换）并写 .sha256"""
+    dst = str(dst or checkpoint)
+    sd = torch.load(checkpoint, map_location="cpu")
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(dst)), prefix=".weights-", suffix=".pt")
+    os.close(fd)
+    try:
+        torch.save(sd, tmp)
+        os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    return write_sidecar(dst)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('paths', nargs='+', help='权重文件或目录（目录取其中的 *.pt）')
+    parser.add_argument('--convert', action='store_true', help='转成可 mmap 的格式并写 .sha256')
+    parser.add_argument('--seal', action='store_true', help='只为现有权重写 .sha256')
+    args = parser.parse_args()
+    files = []
+    for p in map(pathlib.Path, args.paths):
+        files.extend(sorted(p.glob("*.pt")) if p.is_dir() else [p])
+    for f in files:
+        if args.convert:
+            print(f"{f}: converted, sha256={convert(f)}")
+        elif args.seal:
+            print(f"{f}: sha256={write_sidecar(f)}")
+        else:
+            try:
+                state = "ok" if verify(f) else "no .sha256"
+            except IntegrityError as e:
+                state = f"MISMATCH ({e})"
+            print(f"{f}: {'mmap' if is_mmappable(f) else 'legacy'}, {state}")